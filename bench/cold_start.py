@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Cold-start cost of lambda_function, per event type.
+
+Every event type runs in a fresh interpreter: lambda_function is imported
+and event_handler is called once with the event, against the stand-ins
+from bench/offline.py (a local HTTP server for Fitbit, LINE and Docomo,
+FakeDynamoDB for DynamoDB, and a dispatcher that only records what would
+be invoked asynchronously). Every path talks to DynamoDB in production, so
+boto3 is imported and the real DynamoDB resource is built first (no
+network needed) and counted in the total. Reported per event type: import
+time, boto3 time, time of the first event_handler call, and which
+third-party modules are in sys.modules after the import and after the
+call. Exits with status 1 when
+a budget is exceeded, when an event fails or logs an error, or when
+pandas/numpy/fitbit are loaded by a path that should not need them.
+
+    python bench/cold_start.py [--repeat 5] [--users 3] [--history 40]
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BIN_DIR = os.path.join(BENCH_DIR, "..", "bin")
+
+WATCHED = ["requests", "urllib3", "boto3", "botocore", "fitbit", "numpy", "pandas"]
+HEAVY = ["fitbit", "numpy", "pandas"]
+
+# budget in ms for import + DynamoDB resource + first call, and whether the path may load HEAVY modules
+EVENT_TYPES = {"line_chat":(800, False),
+               "line_unregistered":(800, False),
+               "fitbit_callback":(800, False),
+               "line_predict":(800, False),
+               "predict_request":(2500, True),
+               "cloud_watch":(2500, True),
+               }
+
+
+class RecordingDispatcher:
+    # stands in for LambdaDispatcher, async invocations are not part of this cold start
+
+    def __init__(self):
+        self.events = []
+
+    def dispatch(self, event):
+        self.events.append(event)
+
+
+def make_event(event_type, offline):
+    if event_type == "line_chat":
+        return {"events":[offline.line_event("U00000", "こんにちは")]}
+    if event_type == "line_unregistered":
+        return {"events":[offline.line_event("U99999", "こんにちは")]}
+    if event_type == "fitbit_callback":
+        return {"state":"N00000", "code":"codeN00000"}
+    if event_type == "line_predict":
+        return {"events":[offline.line_event("U00000", "おつげ")]}
+    if event_type == "predict_request":
+        return {"PredictRequest":{"line_mid":"U00000", "event_id":"1", "now":offline.FIXED_NOW}}
+    if event_type == "cloud_watch":
+        return {"CloudWatchEvent":{"source":"aws.events"}}
+    raise ValueError(event_type)
+
+
+class ErrorLog(logging.Handler):
+    # event_handler logs and swallows per-event failures, they still fail the probe
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def loaded():
+    return [name for name in WATCHED if name in sys.modules]
+
+
+def probe(event_type, users, history):
+    # runs in the child interpreter
+    sys.path.insert(0, BIN_DIR)
+    start = time.perf_counter()
+    import lambda_function as lf
+    import_ms = (time.perf_counter() - start) * 1000
+    after_import = loaded()
+
+    # what the first DynamoDB call of every path pays before FakeDynamoDB takes over
+    error = None
+    start = time.perf_counter()
+    try:
+        lf.dynamo._DynamoDB__connect()
+    except Exception as e:
+        error = repr(e)
+    boto3_ms = (time.perf_counter() - start) * 1000
+
+    import offline
+    lf.logger.setLevel("WARNING")
+    error_log = ErrorLog()
+    lf.logger.addHandler(error_log)
+    lf.dynamo = offline.FakeDynamoDB(lf)
+    offline.populate(lf.dynamo, users, history, lf.Clock().now)
+    recorder = RecordingDispatcher()
+    lf.dispatchers[lf.PREDICT_DISPATCHER] = recorder
+    lf.PREDICT_ASYNC = True
+    lf.PREDICT_SHARDS = 1
+    event = make_event(event_type, offline)
+
+    start = time.perf_counter()
+    try:
+        lf.event_handler(event, lf.Clock())
+        lf.write_behind.flush()
+    except Exception as e:
+        error = error or repr(e)
+    error = error or (error_log.messages[0] if error_log.messages else None)
+    event_ms = (time.perf_counter() - start) * 1000
+
+    print(json.dumps({"import_ms":import_ms, "boto3_ms":boto3_ms, "event_ms":event_ms, "error":error,
+                      "after_import":after_import, "after_event":loaded(),
+                      "dispatched":[next(iter(event)) for event in recorder.events]}))
+
+
+def run_probe(event_type, endpoint, args):
+    env = dict(os.environ)
+    for name in ["AWS_BOTO3_ACCESS_KEY", "AWS_BOTO3_SECRET_KEY", "LINE_CHANNEL_ACCESS_TOKEN",
+                 "FITBIT_CLIENT_ID", "FITBIT_CLIENT_SECRET", "DOCOMO_APIKEY"]:
+        env.setdefault(name, "dummy")
+    env.update({"FITBIT_API_ENDPOINT":endpoint, "LINE_API_ENDPOINT":endpoint, "DOCOMO_API_ENDPOINT":endpoint,
+                "OAUTHLIB_INSECURE_TRANSPORT":"1", "FITBIT_CACHE_BACKEND":"none"})
+    env.setdefault("FIXED_NOW", "2018-06-01T07:00:00")
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--probe", event_type,
+                                   "--users", str(args.users), "--history", str(args.history)], env=env)
+    return json.loads(out.decode("utf-8").strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--users", type=int, default=3)
+    parser.add_argument("--history", type=int, default=40, help="days already stored per user")
+    parser.add_argument("--probe", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.probe:
+        probe(args.probe, args.users, args.history)
+        return
+
+    import offline
+    server, endpoint = offline.start_fake_server(0)
+
+    failed = False
+    for event_type, (budget_ms, heavy_allowed) in EVENT_TYPES.items():
+        runs = [run_probe(event_type, endpoint, args) for _ in range(args.repeat)]
+        totals = sorted(run["import_ms"] + run["boto3_ms"] + run["event_ms"] for run in runs)
+        median = totals[len(totals) // 2]
+        import_median = sorted(run["import_ms"] for run in runs)[len(runs) // 2]
+        boto3_median = sorted(run["boto3_ms"] for run in runs)[len(runs) // 2]
+        errors = [run["error"] for run in runs if run["error"]]
+        leaked = [] if heavy_allowed else [name for name in HEAVY if name in runs[0]["after_event"]]
+
+        over_budget = median > budget_ms
+        failed = failed or over_budget or bool(errors) or bool(leaked)
+        status = ("ERROR {}".format(errors[0]) if errors else "OVER BUDGET" if over_budget
+                  else "HEAVY IMPORT {}".format(leaked) if leaked else "ok")
+        print("{:<18} total:{:8.1f}ms  import:{:7.1f}ms  boto3:{:7.1f}ms  budget:{:6d}ms  {}".format(
+            event_type, median, import_median, boto3_median, budget_ms, status))
+        print("{:<18} on import:{}  after call:{}  dispatched:{}".format(
+            "", runs[0]["after_import"], runs[0]["after_event"], runs[0]["dispatched"]))
+
+    server.shutdown()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
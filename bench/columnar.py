@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Size, speed and parity of ColumnarHistory against the per-day table rows.
+
+Random tables from engine_parity.generate_tables are packed into
+tbl_history items per user, round-tripped through to_item/from_item and
+predicted with ColumnarHistory.predict. The result must equal
+ArrayModel.predict on the same rows, or both must fail (too short a
+history). Item sizes are compared with the JSON size of the stored
+sleep/heart/activities rows. Exits with status 1 on any mismatch.
+
+    python bench/columnar.py [--users 200] [--days 365] [--seed 0]
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+
+from engine_parity import generate_tables, split_by_user, lambda_function
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    date_str = "2018-06-01"
+    users = split_by_user(generate_tables(random.Random(args.seed), args.users, args.days, date_str))
+
+    row_bytes = blob_bytes = 0
+    encode_s = decode_s = 0.0
+    mismatches = []
+    for line_mid, tables in users.items():
+        features = lambda_function.daily_features(*tables)
+        if not features:
+            continue
+        row_bytes += sum(len(json.dumps(row)) for rows in tables for row in rows)
+
+        start = time.perf_counter()
+        items = [history.to_item() for history in lambda_function.ColumnarHistory.upsert({}, line_mid, features)]
+        encode_s += time.perf_counter() - start
+        blob_bytes += sum(len(item["blob"]) for item in items)
+
+        start = time.perf_counter()
+        histories = {item["period"]:lambda_function.ColumnarHistory.from_item(item) for item in items}
+        decode_s += time.perf_counter() - start
+
+        # users with too short a history fail in both engines, only failing matters
+        try:
+            expected = lambda_function.ArrayModel(*tables, date_str)
+            expected = (expected.predict(), expected.base_date_str, bool(expected.is_latest))
+        except Exception:
+            expected = "failed"
+        try:
+            actual = lambda_function.ColumnarHistory.predict(histories, date_str)
+            actual = (actual[0], actual[1], bool(actual[2]))
+        except Exception:
+            actual = "failed"
+        if actual != expected:
+            mismatches.append((line_mid, expected, actual))
+
+    print("rows:{:.1f}KB  blobs:{:.1f}KB  encode:{:.1f}ms  decode:{:.1f}ms".format(
+        row_bytes / 1024, blob_bytes / 1024, encode_s * 1000, decode_s * 1000))
+    for mismatch in mismatches[:20]:
+        print("MISMATCH", *mismatch)
+    print("users:{} mismatches:{}".format(len(users), len(mismatches)))
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
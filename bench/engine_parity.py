@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Parity and timing of the pandas (Model) and NumPy (ArrayModel) prediction engines.
+
+Random sleep/heart/activities tables are generated for many users with
+gaps, several sleeps per day and short histories. Both engines must give
+the same idx, message, base date and latest flag, for Model.predict per
+user and for predict_by_user on the stacked tables. Per-user results,
+including which users fail, must also match BaselineModel, a copy of the
+Model.predict this repo shipped before the engines were rewritten.
+Exits with status 1 on any mismatch.
+
+    python bench/engine_parity.py [--users 200] [--days 100] [--seed 0]
+"""
+
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+for name in ["AWS_BOTO3_ACCESS_KEY", "AWS_BOTO3_SECRET_KEY", "LINE_CHANNEL_ACCESS_TOKEN",
+             "FITBIT_CLIENT_ID", "FITBIT_CLIENT_SECRET", "DOCOMO_APIKEY"]:
+    os.environ.setdefault(name, "dummy")
+
+import lambda_function  # noqa: E402
+from lambda_function import np, pd  # noqa: E402
+
+SLEEP_COLS = ["awakeCount","awakeDuration","awakeningsCount","duration","efficiency","minutesAfterWakeup",
+              "minutesAsleep","minutesAwake","minutesToFallAsleep","restlessCount","restlessDuration"]
+
+
+def generate_tables(rnd, users, days, date_str):
+    today = datetime.datetime.strptime(date_str, "%Y-%m-%d")
+    tbl_sleep, tbl_heart, tbl_activities = [], [], []
+    log_id = 0
+    for u in range(users):
+        line_mid = "U{:05d}".format(u)
+        history = rnd.choice([1, 3, 4, 10, 29, 30, 31, days])
+        for d in range(history):
+            date = (today - datetime.timedelta(days=d)).strftime("%Y-%m-%d")
+            if rnd.random() < 0.9:
+                for _ in range(rnd.choice([1, 1, 1, 2])):
+                    log_id += 1
+                    sleep = {col:rnd.randint(0, 60) for col in SLEEP_COLS}
+                    sleep.update({"line_mid":line_mid, "logId":log_id, "dateOfSleep":date,
+                                  "duration":rnd.randint(3, 9) * 3600000 + rnd.randint(0, 59) * 60000})
+                    tbl_sleep.append(sleep)
+            if rnd.random() < 0.95:
+                tbl_heart.append({"line_mid":line_mid, "dateTime":date, "value":{"restingHeartRate":rnd.randint(50, 80)}})
+            if rnd.random() < 0.95:
+                activity = {name:str(rnd.randint(0, 500)) for name in lambda_function.ExFitbit.TBL_ACTIVITIES}
+                activity.update({"line_mid":line_mid, "dateTime":date})
+                tbl_activities.append(activity)
+    return tbl_sleep, tbl_heart, tbl_activities
+
+
+class BaselineModel:
+    # the original pandas Model, kept verbatim apart from the date_str default
+
+    def __init__(self, tbl_sleep, tbl_heart, tbl_activities, date_str):
+
+        df_sleep = self.__group_df_sleep_by_date(pd.DataFrame(tbl_sleep))
+        df_heart = pd.DataFrame(tbl_heart)
+        df_activities = pd.DataFrame(tbl_activities)
+        df = df_sleep.merge(df_heart, on=["line_mid", "dateTime"])
+        df = df.merge(df_activities, on=["line_mid", "dateTime"])
+        self.df = df
+        self.base_date_str = df["dateTime"].max()
+        self.is_latest = self.base_date_str == date_str
+
+    def __group_df_sleep_by_date(self, df):
+        keys = ["line_mid","dateOfSleep"]
+        return df[keys+SLEEP_COLS].groupby(keys).sum().reset_index().rename(columns={"dateOfSleep":"dateTime"})
+
+    def predict(self):
+
+        df = self.df.sort_values("dateTime").reset_index(drop=True)
+        df = df.loc[len(df)-30:, ["duration","minutesLightlyActive","minutesFairlyActive","minutesVeryActive"]]
+        df = df.astype(float)
+
+        df["activity_idx"] = df["minutesLightlyActive"] + 2*df["minutesFairlyActive"] + 3*df["minutesVeryActive"]
+        df["activity_idx_avg"] = df["activity_idx"].mean()
+        df["activity_idx_std"] = df["activity_idx"].std()
+        df["idx1"] = 4 * (df["activity_idx"] > df["activity_idx_avg"] + df["activity_idx_std"])
+        df["idx1"] = df["idx1"] + 3 * ((df["activity_idx"] > df["activity_idx_avg"]) & (df["idx1"] < 4))
+        df["idx1"] = df["idx1"] + 2 * ((df["activity_idx"] > df["activity_idx_avg"] - df["activity_idx_std"]) & (df["idx1"] < 3))
+        df["idx1"] = df["idx1"] + 1 * (df["idx1"] < 2)
+        idx1 = df["idx1"].values[-1]
+        idx2 = 1*((df["idx1"].values[-4:]-2.5).dot(np.array([0.2,0.5,0.7,1])) > 1.5)
+
+        df["duration_avg"] = df["duration"].mean()
+        df["duration_std"] = df["duration"].std()
+        df["idx3"] = 4 * (df["duration"] > df["duration_avg"] + df["duration_std"])
+        df["idx3"] = df["idx3"] + 3 * ((df["duration"] > df["duration_avg"]) & (df["idx3"] < 4))
+        df["idx3"] = df["idx3"] + 2 * ((df["duration"] > df["duration_avg"] - df["duration_std"]) & (df["idx3"] < 3))
+        df["idx3"] = df["idx3"] + 1 * (df["idx3"] < 2)
+        idx3 = df["idx3"].values[-1]
+        idx4 = 1*((df["idx3"].values[-4:]-2.5).dot(np.array([0.2,0.5,0.7,1])) > 1.5)
+
+        idx = "{}{}{}{}".format(idx1,idx2,idx3,idx4)
+
+        return idx, lambda_function.Model.tmp[idx]
+
+
+def split_by_user(tables):
+    users = {}
+    for i, rows in enumerate(tables):
+        for row in rows:
+            users.setdefault(row["line_mid"], ([], [], []))[i].append(row)
+    return users
+
+
+def run_single(engine, users, date_str):
+    results = {}
+    for line_mid, tables in users.items():
+        try:
+            model = engine(*tables, date_str)
+            results[line_mid] = (model.predict(), model.base_date_str, bool(model.is_latest))
+        except Exception:
+            # the failure type differs between engines for users without joined rows, only failing matters
+            results[line_mid] = "failed"
+    return results
+
+
+def run_batch(engine, tables, date_str):
+    model = engine(*tables, date_str)
+    predictions = model.predict_by_user()
+    return {line_mid:(prediction, model.base_date_strs[line_mid], bool(model.latest_by_user[line_mid]))
+            for line_mid, prediction in predictions.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--days", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    date_str = "2018-06-01"
+    tables = generate_tables(random.Random(args.seed), args.users, args.days, date_str)
+    users = split_by_user(tables)
+
+    outputs = {}
+    for name, engine in lambda_function.MODEL_ENGINES.items():
+        start = time.perf_counter()
+        single = run_single(engine, users, date_str)
+        single_s = time.perf_counter() - start
+        start = time.perf_counter()
+        batch = run_batch(engine, tables, date_str)
+        batch_s = time.perf_counter() - start
+        outputs[name] = (single, batch)
+        print("{:<8} single:{:8.1f}ms  batch:{:8.1f}ms".format(name, single_s * 1000, batch_s * 1000))
+
+    start = time.perf_counter()
+    baseline = run_single(BaselineModel, users, date_str)
+    print("{:<8} single:{:8.1f}ms".format("baseline", (time.perf_counter() - start) * 1000))
+
+    (single_a, batch_a), (single_b, batch_b) = outputs["pandas"], outputs["numpy"]
+    mismatches = [line_mid for line_mid in users if single_a[line_mid] != single_b[line_mid]]
+    mismatches += [line_mid for line_mid in users if baseline[line_mid] != single_a[line_mid]]
+    mismatches += [line_mid for line_mid in set(batch_a) | set(batch_b) if batch_a.get(line_mid) != batch_b.get(line_mid)]
+    mismatches += [line_mid for line_mid in users if batch_a.get(line_mid, "failed") != single_a[line_mid]]
+
+    for line_mid in sorted(set(mismatches))[:20]:
+        print("MISMATCH", line_mid, baseline[line_mid], single_a[line_mid], single_b[line_mid], batch_a.get(line_mid), batch_b.get(line_mid))
+    print("users:{} mismatches:{}".format(len(users), len(set(mismatches))))
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
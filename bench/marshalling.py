@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of to_dynamo against the former json round trip.
+
+Rows shaped like tbl_sleep, tbl_heart and tbl_activities items are
+converted repeatedly with both approaches. Both outputs are checked for
+equality on rows the json round trip can handle. When NumPy is installed,
+rows holding NumPy scalars and arrays must convert exactly like the same
+rows with plain Python values.
+
+    python bench/marshalling.py [--rows 1000] [--repeat 5]
+"""
+
+import argparse
+import decimal
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+for name in ["AWS_BOTO3_ACCESS_KEY", "AWS_BOTO3_SECRET_KEY", "LINE_CHANNEL_ACCESS_TOKEN",
+             "FITBIT_CLIENT_ID", "FITBIT_CLIENT_SECRET", "DOCOMO_APIKEY"]:
+    os.environ.setdefault(name, "dummy")
+
+import lambda_function  # noqa: E402
+
+
+def json_round_trip(dict_):
+    return json.loads(json.dumps(dict_), parse_float=decimal.Decimal)
+
+
+def generate_rows(rnd, count):
+    rows = []
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            row = {"line_mid":"U0001", "logId":rnd.randint(1, 10**10), "dateOfSleep":"2018-05-01",
+                   "startTime":"2018-04-30T23:10:00.000", "endTime":"2018-05-01T06:40:00.000",
+                   "isMainSleep":True, "efficiency":rnd.randint(80, 99), "duration":rnd.randint(1, 9) * 3600000}
+            row.update({"minutes{}".format(n):rnd.randint(0, 500) for n in range(12)})
+        elif kind == 1:
+            row = {"line_mid":"U0001", "dateTime":"2018-05-01",
+                   "value":{"restingHeartRate":rnd.randint(50, 80),
+                            "customHeartRateZones":[],
+                            "heartRateZones":[{"name":zone, "min":rnd.randint(30, 150), "max":rnd.randint(150, 220),
+                                               "minutes":rnd.randint(0, 600), "caloriesOut":rnd.random() * 2000}
+                                              for zone in ["Out of Range", "Fat Burn", "Cardio", "Peak"]]}}
+        else:
+            row = {"line_mid":"U0001", "dateTime":"2018-05-01"}
+            row.update({name:str(rnd.randint(0, 2000)) for name in lambda_function.ExFitbit.TBL_ACTIVITIES})
+        rows.append(row)
+    return rows
+
+
+def numpy_rows(rnd, count):
+    # (row with NumPy values, the same row with plain Python values)
+    import numpy as np
+    pairs = []
+    for _ in range(count):
+        values = [rnd.random() * 1000 for _ in range(4)]
+        steps = rnd.randint(0, 30000)
+        numpy_row = {"line_mid":"U0001", "dateTime":"2018-05-01",
+                     "duration":np.float64(values[0]), "steps":np.int64(steps),
+                     "efficiency":np.float32(0.5), "window":np.array(values[1:]),
+                     "missing":np.float64("nan")}
+        plain_row = {"line_mid":"U0001", "dateTime":"2018-05-01",
+                     "duration":values[0], "steps":steps,
+                     "efficiency":0.5, "window":values[1:],
+                     "missing":float("nan")}
+        pairs.append((numpy_row, plain_row))
+    return pairs
+
+
+def measure(convert, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for row in rows:
+            convert(row)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = generate_rows(random.Random(0), args.rows)
+    mismatches = sum(1 for row in rows if json_round_trip(row) != lambda_function.to_dynamo(row))
+    try:
+        pairs = numpy_rows(random.Random(1), args.rows)
+    except ImportError:
+        print("numpy not installed, numpy scalars not checked")
+        pairs = []
+    numpy_mismatches = sum(1 for numpy_row, plain_row in pairs
+                           if lambda_function.to_dynamo(numpy_row) != lambda_function.to_dynamo(plain_row))
+
+    json_s = measure(json_round_trip, rows, args.repeat)
+    walk_s = measure(lambda_function.to_dynamo, rows, args.repeat)
+    print("json round trip: {:8.2f}us/row".format(json_s / len(rows) * 1e6))
+    print("to_dynamo:       {:8.2f}us/row  ({:.1f}x)".format(walk_s / len(rows) * 1e6, json_s / walk_s))
+    print("mismatches:{} numpy_mismatches:{}".format(mismatches, numpy_mismatches))
+    sys.exit(1 if mismatches or numpy_mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of lambda_handler with local stand-ins for every external service.
+
+A local HTTP server plays Fitbit, LINE and Docomo (the endpoints are
+redirected with FITBIT_API_ENDPOINT, LINE_API_ENDPOINT and
+DOCOMO_API_ENDPOINT). An in-memory FakeDynamoDB replaces the module-level
+DynamoDB instance. Webhook, CloudWatch and OAuth-callback events are
+replayed for a configurable number of users and days of stored history.
+
+Reported per scenario: p50/p99 latency per invocation, calls per external
+service and DynamoDB operation, and wall/CPU time per phase (fetch,
+merge, predict, push).
+
+    python bench/offline.py [--users 50] [--history 100] [--latency-ms 20]
+                            [--scenarios webhook,chat,cloudwatch,oauth] [--json]
+"""
+
+import argparse
+import collections
+import copy
+import datetime
+import functools
+import http.server
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin")
+FIXED_NOW = "2018-06-01T07:00:00"
+
+ACTIVITIES = ["calories","caloriesBMR","steps","distance","minutesSedentary","minutesLightlyActive",
+              "minutesFairlyActive","minutesVeryActive","activityCalories"]
+SCOPES = "activity heartrate location nutrition profile settings sleep social weight"
+
+
+##############################
+# synthetic Fitbit data, identical for the fake API and the pre-populated tables
+
+def day_random(line_mid, date_str, salt):
+    return random.Random("{}|{}|{}".format(line_mid, date_str, salt))
+
+
+def dates_between(base_date, end_date):
+    day = datetime.datetime.strptime(base_date, "%Y-%m-%d")
+    end = datetime.datetime.strptime(end_date, "%Y-%m-%d")
+    while day <= end:
+        yield day.strftime("%Y-%m-%d")
+        day += datetime.timedelta(days=1)
+
+
+def fitbit_sleep(line_mid, date_str):
+    rnd = day_random(line_mid, date_str, "sleep")
+    duration = rnd.randint(4 * 60, 9 * 60) * 60000
+    return {"logId":int(date_str.replace("-", "")) * 10 + 1,
+            "dateOfSleep":date_str,
+            "startTime":date_str + "T00:00:00.000",
+            "endTime":date_str + "T07:00:00.000",
+            "isMainSleep":True,
+            "duration":duration,
+            "efficiency":rnd.randint(80, 99),
+            "awakeCount":rnd.randint(0, 5), "awakeDuration":rnd.randint(0, 30),
+            "awakeningsCount":rnd.randint(0, 10), "minutesAfterWakeup":rnd.randint(0, 10),
+            "minutesAsleep":duration // 60000 - 20, "minutesAwake":rnd.randint(0, 40),
+            "minutesToFallAsleep":rnd.randint(0, 20), "restlessCount":rnd.randint(0, 10),
+            "restlessDuration":rnd.randint(0, 30), "timeInBed":duration // 60000,
+            "minuteData":[{"dateTime":"00:00:00", "value":"3"}],
+            }
+
+
+def fitbit_heart(line_mid, date_str):
+    rnd = day_random(line_mid, date_str, "heart")
+    return {"dateTime":date_str,
+            "value":{"customHeartRateZones":[],
+                     "restingHeartRate":rnd.randint(50, 80),
+                     "heartRateZones":[{"name":name, "min":low, "max":high,
+                                        "minutes":rnd.randint(0, 600), "caloriesOut":round(rnd.random() * 2000, 4)}
+                                       for name, low, high in [("Out of Range", 30, 94), ("Fat Burn", 94, 131),
+                                                               ("Cardio", 131, 159), ("Peak", 159, 220)]]}}
+
+
+def fitbit_activity(line_mid, date_str, name):
+    return {"dateTime":date_str, "value":str(day_random(line_mid, date_str, name).randint(0, 500))}
+
+
+##############################
+# fake Fitbit / LINE / Docomo HTTP server
+
+class Counters:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def add(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+http_calls = Counters()
+
+SERIES_PATH = re.compile(r"/user/[^/]+/(?P<resource>.+)/date/(?P<base>\d{4}-\d{2}-\d{2})/(?P<end>\d{4}-\d{2}-\d{2})\.json")
+
+
+class FakeServiceHandler(http.server.BaseHTTPRequestHandler):
+
+    latency = 0.0
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, status=200):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Fitbit-Rate-Limit-Remaining", "149")
+        self.send_header("Fitbit-Rate-Limit-Reset", "3600")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        path = urllib.parse.urlparse(self.path).path
+        if path.endswith("/devices.json"):
+            http_calls.add("fitbit:devices")
+            return self.reply([{"id":"1", "type":"TRACKER", "lastSyncTime":FIXED_NOW + ".000"}])
+        match = SERIES_PATH.search(path)
+        if not match:
+            http_calls.add("fitbit:unknown")
+            return self.reply({"errors":[{"errorType":"not_found"}]}, 404)
+
+        line_mid = self.headers.get("Authorization", "").rsplit("-", 1)[-1]
+        resource, base, end = match.group("resource"), match.group("base"), match.group("end")
+        dates = list(dates_between(base, end))
+        http_calls.add("fitbit:" + resource.split("/")[0])
+        if resource == "sleep":
+            return self.reply({"sleep":[fitbit_sleep(line_mid, date_str) for date_str in dates]})
+        if resource == "activities/heart":
+            return self.reply({"activities-heart":[fitbit_heart(line_mid, date_str) for date_str in dates]})
+        name = resource.split("/", 1)[1]
+        return self.reply({"activities-" + name:[fitbit_activity(line_mid, date_str, name) for date_str in dates]})
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        body = self.read_body()
+        path = urllib.parse.urlparse(self.path).path
+        if path.startswith("/v2/bot/message/"):
+            http_calls.add("line:" + path.rsplit("/", 1)[-1])
+            return self.reply({})
+        if path.endswith("/registration"):
+            http_calls.add("docomo:registration")
+            return self.reply({"appId":"docomo-app"})
+        if path.endswith("/dialogue"):
+            http_calls.add("docomo:dialogue")
+            return self.reply({"serverSendTime":"2018-06-01 07:00:00", "systemText":{"utterance":"こんにちは"}})
+        if path == "/oauth2/token":
+            http_calls.add("fitbit:oauth2")
+            form = urllib.parse.parse_qs(body.decode("utf-8"))
+            user_id = form.get("code", form.get("refresh_token", ["refreshed"]))[0]
+            return self.reply({"user_id":user_id, "access_token":"token-" + user_id, "refresh_token":"refresh-" + user_id,
+                               "expires_in":28800, "scope":SCOPES, "token_type":"Bearer"})
+        http_calls.add("unknown:" + path)
+        return self.reply({}, 404)
+
+
+def start_fake_server(latency_ms):
+    FakeServiceHandler.latency = latency_ms / 1000.0
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeServiceHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}".format(server.server_address[1])
+
+
+##############################
+# in-memory stand-in for the DynamoDB class
+
+class FakeDynamoDB:
+
+    KEYS = {"tbl_sleep":"logId", "tbl_heart":"dateTime", "tbl_activities":"dateTime", "tbl_daily_features":"dateTime",
+            "tbl_history":"period", "tbl_fitbit_cache":"cache_key"}
+
+    def __init__(self, lf):
+        self.lf = lf
+        self.lock = threading.Lock()
+        self.tables = collections.defaultdict(dict)
+        self.calls = Counters()
+        self.m_user_cache = lf.TTLCache(lf.M_USER_CACHE_SIZE, lf.M_USER_CACHE_TTL)
+
+    def __store(self, table_name, item):
+        item = self.lf.from_dynamo(self.lf.to_dynamo(item))
+        key = (item["line_mid"], item[self.KEYS[table_name]]) if table_name in self.KEYS else item["line_mid"]
+        with self.lock:
+            self.tables[table_name][key] = item
+
+    def get_m_user(self, line_mid, use_cache=True):
+        if use_cache:
+            item = self.m_user_cache.get(line_mid)
+            if item:
+                return json.loads(json.dumps(item))
+        self.calls.add("get_item")
+        with self.lock:
+            item = self.tables["m_user"].get(line_mid)
+        item = json.loads(json.dumps(item)) if item else None
+        if item:
+            self.m_user_cache.put(line_mid, json.loads(json.dumps(item)))
+        return item
+
+    def put_user(self, item):
+        self.calls.add("put_item")
+        self.m_user_cache.invalidate(item["line_mid"])
+        self.__store("m_user", item)
+
+    def batch_write(self, table_name, items):
+        self.calls.add("batch_write")
+        self.calls.add("batch_write_items", len(items))
+        for item in items:
+            self.__store(table_name, item)
+
+    def query_by_datetime(self, line_mid, table_name, datetime_key, datetime_str):
+        self.calls.add("query")
+        with self.lock:
+            rows = [row for key, row in self.tables[table_name].items()
+                    if key[0] == line_mid and row.get(datetime_key, "") >= datetime_str]
+        return json.loads(json.dumps(rows))
+
+    def query_latest(self, line_mid, table_name, limit):
+        self.calls.add("query")
+        with self.lock:
+            rows = [row for key, row in self.tables[table_name].items() if key[0] == line_mid]
+        rows = sorted(rows, key=lambda row: row[self.KEYS[table_name]])[-limit:]
+        return copy.deepcopy(rows)
+
+    def update(self, line_mid, table, attributes):
+        self.calls.add("update_item")
+        with self.lock:
+            self.tables[table].setdefault(line_mid, {"line_mid":line_mid}).update(
+                self.lf.from_dynamo(self.lf.to_dynamo(attributes)))
+        if table == "m_user":
+            self.m_user_cache.patch(line_mid, attributes)
+
+    def update_token(self, line_mid, token, previous_refresh_token):
+        self.calls.add("update_item")
+        self.m_user_cache.invalidate(line_mid)
+        with self.lock:
+            m_user = self.tables["m_user"][line_mid]
+            if m_user["refresh_token"] != previous_refresh_token:
+                return False
+            for key in ["access_token", "refresh_token", "expires_in", "token_issued_at"]:
+                m_user[key] = token[key]
+        return True
+
+    def get_fitbit_cache(self, line_mid, cache_key):
+        self.calls.add("get_item")
+        with self.lock:
+            return self.tables["tbl_fitbit_cache"].get((line_mid, cache_key))
+
+    def put_fitbit_cache(self, item):
+        self.calls.add("put_item")
+        self.__store("tbl_fitbit_cache", item)
+
+    def claim(self, line_mid, idempotency_key, ttl=60 * 60 * 24 * 2):
+        self.calls.add("put_item")
+        now = time.time()
+        with self.lock:
+            keys = self.tables["tbl_idempotency"]
+            if keys.get((line_mid, idempotency_key), 0) >= now:
+                return False
+            keys[(line_mid, idempotency_key)] = now + ttl
+        return True
+
+    def extend(self, line_mid, idempotency_key, ttl=60 * 60 * 24 * 2):
+        self.calls.add("put_item")
+        with self.lock:
+            self.tables["tbl_idempotency"][(line_mid, idempotency_key)] = time.time() + ttl
+
+    def release(self, line_mid, idempotency_key):
+        self.calls.add("delete_item")
+        with self.lock:
+            self.tables["tbl_idempotency"].pop((line_mid, idempotency_key), None)
+
+    def record_shard(self, run_id, segment, total_segments, summary):
+        self.calls.add("update_item")
+        with self.lock:
+            run = self.tables["tbl_predict_runs"].setdefault(run_id, {"run_id":run_id, "done_shards":set(), "users":0,
+                                                                       "succeeded":0, "failed":0, "skipped":0})
+            if segment in run["done_shards"]:
+                return None
+            run["done_shards"].add(segment)
+            run["total_segments"] = total_segments
+            for key in ["users", "succeeded", "failed", "skipped"]:
+                run[key] += summary[key]
+            return dict(run, done_shards=set(run["done_shards"]))
+
+    def scan_m_user_segment(self, segment, total_segments, attributes=None):
+        return self.scan_m_user(attributes=attributes, segment=segment, total_segments=total_segments)
+
+    def scan_m_user(self, total_segments=1, attributes=None, segment=None):
+        self.calls.add("scan")
+        with self.lock:
+            items = list(self.tables["m_user"].values())
+        if segment is not None:
+            items = [item for item in items if hash(item["line_mid"]) % total_segments == segment]
+        for item in items:
+            item = json.loads(json.dumps(item))
+            if attributes:
+                item = {key:value for key, value in item.items() if key in attributes}
+            yield item
+
+
+def populate(dynamo, users, history, now):
+    today = now.strftime("%Y-%m-%d")
+    first = (now - datetime.timedelta(days=history)).strftime("%Y-%m-%d") if history else None
+    for u in range(users):
+        line_mid = "U{:05d}".format(u)
+        dynamo.put_user({"line_mid":line_mid, "fitbit_id":"F" + line_mid,
+                         "access_token":"token-" + line_mid, "refresh_token":"refresh-" + line_mid,
+                         "scope":SCOPES, "expires_in":28800,
+                         "token_issued_at":int(time.time())})
+        if not history:
+            continue
+        # history stops yesterday, so every run has a new day to fetch
+        dates = list(dates_between(first, today))[:-1]
+        tables = ([dict(fitbit_sleep(line_mid, d), line_mid=line_mid) for d in dates],
+                  [dict(fitbit_heart(line_mid, d), line_mid=line_mid) for d in dates],
+                  [dict({"dateTime":d, "line_mid":line_mid}, **{name:fitbit_activity(line_mid, d, name)["value"] for name in ACTIVITIES})
+                   for d in dates])
+        for table_name, rows in zip(["tbl_sleep", "tbl_heart", "tbl_activities"], tables):
+            dynamo.batch_write(table_name, rows)
+        dynamo.batch_write("tbl_daily_features", dynamo.lf.daily_features(*tables))
+    dynamo.calls = Counters()
+
+
+##############################
+# phase timing
+
+class Phases:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = collections.defaultdict(lambda: {"calls":0, "wall":0.0, "cpu":0.0})
+
+    def wrap(self, phase, function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+                with self.lock:
+                    total = self.totals[phase]
+                    total["calls"] += 1
+                    total["wall"] += wall
+                    total["cpu"] += cpu
+        return timed
+
+    def instrument(self, lf):
+        targets = {"fetch":[(lf.ExFitbit, "time_series"), (lf.ExFitbit, "get_sleep_range")],
+                   "merge":[(lf, "merge_rows"), (lf, "daily_features")],
+                   "predict":[(lf.Model, "predict"), (lf.Model, "predict_by_user"),
+                              (lf.ArrayModel, "predict"), (lf.ArrayModel, "predict_by_user"),
+                              (lf.RollingState, "predict")],
+                   "push":[(lf.LineDelivery, "flush"), (lf, "line_push"), (lf, "line_reply")],
+                   }
+        for phase, functions in targets.items():
+            for owner, name in functions:
+                setattr(owner, name, self.wrap(phase, getattr(owner, name)))
+
+    def reset(self):
+        with self.lock:
+            self.totals.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return {phase:dict(total) for phase, total in self.totals.items()}
+
+
+##############################
+# scenarios
+
+def line_event(line_mid, text):
+    return {"type":"message", "replyToken":"reply-" + line_mid,
+            "source":{"type":"user", "userId":line_mid},
+            "message":{"type":"text", "id":"1", "text":text}}
+
+
+def scenario_events(name, users):
+    line_mids = ["U{:05d}".format(u) for u in range(users)]
+    if name == "webhook":
+        return [{"events":[line_event(line_mid, "おつげ")]} for line_mid in line_mids]
+    if name == "chat":
+        return [{"events":[line_event(line_mid, "こんにちは")]} for line_mid in line_mids]
+    if name == "cloudwatch":
+        return [{"CloudWatchEvent":{"source":"aws.events"}}]
+    if name == "oauth":
+        return [{"state":"N{:05d}".format(u), "code":"code{:05d}".format(u)} for u in range(users)]
+    raise ValueError(name)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run_scenario(lf, name, args, phases):
+    lf.dynamo = FakeDynamoDB(lf)
+    lf.write_behind.updates.clear()
+    populate(lf.dynamo, args.users, args.history, lf.Clock().now)
+    if lf.fitbit_cache:
+        lf.fitbit_cache.backend = lf.MemoryCacheBackend()
+    http_calls.counts.clear()
+    phases.reset()
+
+    latencies = []
+    errors = 0
+    cpu = time.process_time()
+    for event in scenario_events(name, args.users):
+        start = time.perf_counter()
+        try:
+            lf.lambda_handler(event, None)
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - start)
+    cpu = time.process_time() - cpu
+
+    return {"scenario":name,
+            "invocations":len(latencies),
+            "errors":errors,
+            "p50_ms":round(percentile(latencies, 0.5) * 1000, 1),
+            "p99_ms":round(percentile(latencies, 0.99) * 1000, 1),
+            "total_s":round(sum(latencies), 3),
+            "process_cpu_s":round(cpu, 3),
+            "http_calls":http_calls.snapshot(),
+            "dynamo_calls":lf.dynamo.calls.snapshot(),
+            "phases":{phase:{"calls":total["calls"], "wall_s":round(total["wall"], 3), "cpu_s":round(total["cpu"], 3)}
+                      for phase, total in phases.snapshot().items()},
+            }
+
+
+def print_report(report):
+    print("== {scenario}: {invocations} invocations, {errors} errors, p50 {p50_ms}ms, p99 {p99_ms}ms, "
+          "total {total_s}s, cpu {process_cpu_s}s".format(**report))
+    print("   http:   " + ", ".join("{}={}".format(key, value) for key, value in sorted(report["http_calls"].items())))
+    print("   dynamo: " + ", ".join("{}={}".format(key, value) for key, value in sorted(report["dynamo_calls"].items())))
+    for phase in ["fetch", "merge", "predict", "push"]:
+        total = report["phases"].get(phase)
+        if total:
+            print("   {:<8} calls:{:6d}  wall:{:8.3f}s  cpu:{:8.3f}s".format(phase, total["calls"], total["wall_s"], total["cpu_s"]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--history", type=int, default=100, help="days already stored per user, 0 for a first sync")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="simulated latency of every fake HTTP call")
+    parser.add_argument("--scenarios", default="webhook,chat,cloudwatch,oauth")
+    parser.add_argument("--shards", type=int, default=1, help="PREDICT_SHARDS for the cloudwatch scenario, run in process")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    server, endpoint = start_fake_server(args.latency_ms)
+    for name in ["AWS_BOTO3_ACCESS_KEY", "AWS_BOTO3_SECRET_KEY", "LINE_CHANNEL_ACCESS_TOKEN",
+                 "FITBIT_CLIENT_ID", "FITBIT_CLIENT_SECRET", "DOCOMO_APIKEY"]:
+        os.environ.setdefault(name, "dummy")
+    os.environ.update({"FITBIT_API_ENDPOINT":endpoint, "LINE_API_ENDPOINT":endpoint, "DOCOMO_API_ENDPOINT":endpoint,
+                       "OAUTHLIB_INSECURE_TRANSPORT":"1", "FIXED_NOW":FIXED_NOW})
+    os.environ.setdefault("FITBIT_CACHE_BACKEND", "none")
+
+    sys.path.insert(0, BIN_DIR)
+    import lambda_function as lf
+    lf.logger.setLevel("WARNING")
+    lf.PREDICT_SHARDS = args.shards
+    lf.PREDICT_DISPATCHER = "local"
+
+    phases = Phases()
+    phases.instrument(lf)
+
+    reports = [run_scenario(lf, name, args, phases) for name in args.scenarios.split(",")]
+    server.shutdown()
+
+    if args.json:
+        print(json.dumps(reports, indent=2, ensure_ascii=False))
+    else:
+        for report in reports:
+            print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,26 +5,55 @@ Created on Sat Apr 28 07:44:37 2018
 @author: suzuki
 """
 
-import requests
 import json
 import os
-import boto3
-from boto3.dynamodb.conditions import Key
 import logging
-import numpy as np
-import pandas as pd
-import fitbit
+import importlib
 import base64
-import urllib
+import urllib.parse
 import datetime
 import decimal
+import time
+import threading
+import queue
+import bisect
+import uuid
+import copy
+import collections
+import contextlib
+import random
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+class LazyModule:
+    # heavy dependencies are imported on first attribute access, so the chat and
+    # OAuth callback paths never pay for pandas/numpy at cold start
+
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attr):
+        if self.__module is None:
+            self.__module = importlib.import_module(self.__name)
+        return getattr(self.__module, attr)
+
+requests = LazyModule("requests")
+boto3 = LazyModule("boto3")
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
+fitbit = LazyModule("fitbit")
 
 AWS_BOTO3_ACCESS_KEY = os.environ["AWS_BOTO3_ACCESS_KEY"]
 AWS_BOTO3_SECRET_KEY = os.environ["AWS_BOTO3_SECRET_KEY"]
 AWS_REGION = "ap-northeast-1"
 
-LINE_URL_REPLY = 'https://api.line.me/v2/bot/message/reply'
-LINE_URL_PUSH = 'https://api.line.me/v2/bot/message/push'
+LINE_API_ENDPOINT = os.environ.get("LINE_API_ENDPOINT", "https://api.line.me")
+LINE_URL_REPLY = LINE_API_ENDPOINT + '/v2/bot/message/reply'
+LINE_URL_PUSH = LINE_API_ENDPOINT + '/v2/bot/message/push'
+LINE_URL_MULTICAST = LINE_API_ENDPOINT + '/v2/bot/message/multicast'
+LINE_MAX_MESSAGES = 5
+LINE_MAX_MULTICAST = 500
 LINE_HEADERS = {
     'Authorization': 'Bearer ' + os.environ['LINE_CHANNEL_ACCESS_TOKEN'],
     'Content-type': 'application/json'
@@ -33,19 +62,98 @@ LINE_HEADERS = {
 FITBIT_CLIENT_ID = os.environ["FITBIT_CLIENT_ID"]
 FITBIT_CLIENT_SECRET = os.environ["FITBIT_CLIENT_SECRET"]
 FITBIT_REDIRECT_URI = "https://0knbiipk1h.execute-api.ap-northeast-1.amazonaws.com:443/prd/v1"
+FITBIT_API_ENDPOINT = os.environ.get("FITBIT_API_ENDPOINT", "https://api.fitbit.com")
 FITBIT_SCOPES = "activity heartrate location nutrition profile settings sleep social weight"
 FITBIT_AUTH_URL = "https://www.fitbit.com/oauth2/authorize?response_type=code&client_id={}&redirect_uri={}&scope={}&expires_in=3600000".format(FITBIT_CLIENT_ID,urllib.parse.quote(FITBIT_REDIRECT_URI),urllib.parse.quote(FITBIT_SCOPES))
 
 DOCOMO_APIKEY = os.environ["DOCOMO_APIKEY"]
-DOCOMO_CHAT_ENDPOINT = "https://api.apigw.smt.docomo.ne.jp/naturalChatting/v1/dialogue?APIKEY={}".format(DOCOMO_APIKEY)
-DOCOMO_REGISTER_ENDPOINT = "https://api.apigw.smt.docomo.ne.jp/naturalChatting/v1/registration?APIKEY={}".format(DOCOMO_APIKEY)
+DOCOMO_API_ENDPOINT = os.environ.get("DOCOMO_API_ENDPOINT", "https://api.apigw.smt.docomo.ne.jp")
+DOCOMO_CHAT_ENDPOINT = "{}/naturalChatting/v1/dialogue?APIKEY={}".format(DOCOMO_API_ENDPOINT, DOCOMO_APIKEY)
+DOCOMO_REGISTER_ENDPOINT = "{}/naturalChatting/v1/registration?APIKEY={}".format(DOCOMO_API_ENDPOINT, DOCOMO_APIKEY)
 
-DATETIME_NOW = datetime.datetime.now()
+# first syncs and table queries cover the model's window plus a margin for days without data;
+# the longer BASE_PERIOD history is fetched by backfill_history in the background
 BASE_PERIOD = 100
+PREDICT_WINDOW = 30
+HISTORY_MARGIN = int(os.environ.get("HISTORY_MARGIN", "7"))
+HISTORY_PERIOD = PREDICT_WINDOW + HISTORY_MARGIN
+# longest date range each Fitbit endpoint accepts in one call
+FITBIT_MAX_SPANS = {"sleep":100, "activities/heart":365}
+FITBIT_MAX_SPAN = 1095
+
+M_USER_CACHE_SIZE = int(os.environ.get("M_USER_CACHE_SIZE", "1024"))
+M_USER_CACHE_TTL = int(os.environ.get("M_USER_CACHE_TTL", "300"))
+
+LINE_EVENT_WORKERS = int(os.environ.get("LINE_EVENT_WORKERS", "8"))
+
+HTTP_TIMEOUT = (3.05, 10)
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.3
+
+PREDICT_ALL_WORKERS = int(os.environ.get("PREDICT_ALL_WORKERS", "8"))
+PREDICT_BATCH_SIZE = int(os.environ.get("PREDICT_BATCH_SIZE", "100"))
+# the nightly summary is one log line of counts and latency percentiles, with a sample of failed users
+PREDICT_SUMMARY_MAX_LINE_MIDS = 20
+SCAN_TOTAL_SEGMENTS = int(os.environ.get("SCAN_TOTAL_SEGMENTS", "1"))
+PREDICT_SHARDS = int(os.environ.get("PREDICT_SHARDS", "1"))
+PREDICT_DISPATCHER = os.environ.get("PREDICT_DISPATCHER", "lambda")
+PREDICT_FUNCTION_NAME = os.environ.get("PREDICT_FUNCTION_NAME", os.environ.get("AWS_LAMBDA_FUNCTION_NAME", ""))
+IDEMPOTENCY_TTL = 60 * 60 * 24 * 2
+PREDICT_ASYNC = os.environ.get("PREDICT_ASYNC", "1") == "1"
+# upper bound on how long a crashed or timed-out prediction keeps blocking the user's next おつげ
+# and the retry of its async invocation; keep it at least the function timeout
+PREDICT_DEDUP_WINDOW = int(os.environ.get("PREDICT_DEDUP_WINDOW", "60"))
+M_USER_PREDICT_ATTRIBUTES = ["line_mid","access_token","refresh_token","expires_in","token_issued_at","rolling_state",
+                             "last_sync_time","last_prediction"]
+# opt-in: the nightly run skips users whose devices did not sync since their last prediction,
+# and then pushes their last prediction again ("cached") or nothing ("skip")
+PREDICT_CHANGE_DETECTION = os.environ.get("PREDICT_CHANGE_DETECTION", "0") == "1"
+PREDICT_UNCHANGED = os.environ.get("PREDICT_UNCHANGED", "cached")
+FITBIT_ACTIVITY_WORKERS = int(os.environ.get("FITBIT_ACTIVITY_WORKERS", "9"))
+FITBIT_CACHE_BACKEND = os.environ.get("FITBIT_CACHE_BACKEND", "none")
+FITBIT_CACHE_TTL = int(os.environ.get("FITBIT_CACHE_TTL", "600"))
+FITBIT_CACHE_RETENTION = 60 * 60 * 24 * BASE_PERIOD
+FITBIT_RATE_LIMIT_MARGIN = int(os.environ.get("FITBIT_RATE_LIMIT_MARGIN", "20"))
+FITBIT_TOKEN_REFRESH_MARGIN = 300
+PREDICT_SOURCE = os.environ.get("PREDICT_SOURCE", "tables")
+# tbl_daily_features is written only when predictions read it, or to fill it before switching
+DAILY_FEATURES_ENABLED = PREDICT_SOURCE == "features" or os.environ.get("DAILY_FEATURES_ENABLED", "0") == "1"
+BACKFILL_WORKERS = int(os.environ.get("BACKFILL_WORKERS", "8"))
+BACKFILL_SINCE = "1970-01-01"
+PREDICT_ENGINE = os.environ.get("PREDICT_ENGINE", "pandas")
+ROLLING_STATE_MAX_AGE = 7
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0"))
+TRACE_OUTPUT = os.environ.get("TRACE_OUTPUT", "json")
+TRACE_NAMESPACE = os.environ.get("TRACE_NAMESPACE", "miromiro")
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+class Clock:
+    # one "now" per request; FIXED_NOW (ISO format) pins it for deterministic runs
+
+    FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+    def __init__(self, now=None):
+        if now is None and os.environ.get("FIXED_NOW"):
+            now = datetime.datetime.strptime(os.environ["FIXED_NOW"], self.FORMAT)
+        self.now = now or datetime.datetime.now()
+        self.__date_strs = {}
+
+    def date_str(self, days_ago=0):
+        if days_ago not in self.__date_strs:
+            self.__date_strs[days_ago] = (self.now - datetime.timedelta(days=days_ago)).strftime("%Y-%m-%d")
+        return self.__date_strs[days_ago]
+
+    @property
+    def today_str(self):
+        return self.date_str()
+
+    @property
+    def yesterday_str(self):
+        return self.date_str(1)
+
+
 class Error:    
     ERRORS = {1:"Fitbit連携時に拒否以外のerror",
               2:"Fitbit連携時にエラーはないがcodeがNone",
@@ -60,6 +168,88 @@ class Error:
 def log_error(error_code, option=""):
     logger.error("[ERROR_CODE_{0:04d}]:{1} {2}".format(error_code, Error.code(error_code), option))
 
+
+class LazyJson:
+    # serialized only when the record is actually emitted
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return json.dumps(self.value, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+class Tracer:
+    # timing spans around external calls and predictions; invocations that are not
+    # sampled only pay for entering an empty context manager
+    
+    EMF_MAX_VALUES = 100
+
+    def __init__(self, sample_rate=TRACE_SAMPLE_RATE, output=TRACE_OUTPUT, namespace=TRACE_NAMESPACE):
+        self.sample_rate = sample_rate
+        self.output = output
+        self.namespace = namespace
+        self.sampled = False
+        self.spans = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        # decided once per invocation so a sampled request is traced end to end
+        self.sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        with self.lock:
+            self.spans = {}
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        if not self.sampled:
+            yield
+            return
+
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.__record(name, (time.perf_counter() - start) * 1000, error, attributes)
+
+    def __record(self, name, elapsed, error, attributes):
+        with self.lock:
+            self.spans.setdefault(name, []).append(elapsed)
+        if self.output == "json":
+            record = {"span":name, "ms":round(elapsed, 2)}
+            record.update(attributes)
+            if error:
+                record["error"] = error
+            logger.info("[SPAN]:%s", LazyJson(record))
+
+    def flush(self):
+        if not self.sampled:
+            return
+        with self.lock:
+            spans, self.spans = self.spans, {}
+
+        if self.output == "emf":
+            # CloudWatch Embedded Metric Format must be the whole log line, so it bypasses the logger
+            for name, values in spans.items():
+                for i in range(0, len(values), self.EMF_MAX_VALUES):
+                    print(LazyJson(self.__emf(name, values[i:i+self.EMF_MAX_VALUES])), flush=True)
+            return
+
+        summary = {name:{"cnt":len(values), "ms":round(sum(values), 2), "max":round(max(values), 2)}
+                   for name, values in spans.items()}
+        logger.info("[SPAN_SUMMARY]:%s", LazyJson(summary))
+
+    def __emf(self, name, values):
+        return {"_aws":{"Timestamp":int(time.time() * 1000),
+                        "CloudWatchMetrics":[{"Namespace":self.namespace,
+                                              "Dimensions":[["Span"]],
+                                              "Metrics":[{"Name":"Duration", "Unit":"Milliseconds"}]}]},
+                "Span":name,
+                "Duration":[round(value, 2) for value in values]}
+
 ##############################
 
 class Docomo:    
@@ -80,11 +270,13 @@ class Docomo:
         headers = {"Content-type": "application/json"}
         payload = {"botId":"Chatting", "appKind":"Smart Phone"}
            
-        res = requests.post(DOCOMO_REGISTER_ENDPOINT, data=json.dumps(payload), headers=headers)
-        data = res.json()
+        with tracer.span("docomo.registration"):
+            res = http_session().post(DOCOMO_REGISTER_ENDPOINT, data=json.dumps(payload), headers=headers, timeout=HTTP_TIMEOUT)
+            data = res.json()
 
         docomo_id = data["appId"]   
-        dynamo.update(self.m_user["line_mid"], "m_user", "docomo_id", docomo_id)
+        self.m_user["docomo_id"] = docomo_id
+        write_behind.update(self.m_user["line_mid"], "m_user", "docomo_id", docomo_id)
        
         return docomo_id
         
@@ -101,80 +293,193 @@ class Docomo:
                    "voiceText":text,"appRecvTime":docomo_recv_time,
                    "appSendTime":docomo_send_time}
            
-        res = requests.post(DOCOMO_CHAT_ENDPOINT, data=json.dumps(payload), headers=headers)
-        data = res.json()
+        with tracer.span("docomo.dialogue"):
+            res = http_session().post(DOCOMO_CHAT_ENDPOINT, data=json.dumps(payload), headers=headers, timeout=HTTP_TIMEOUT)
+            data = res.json()
         
         docomo_send_time = data["serverSendTime"]
         system_text = data["systemText"]["utterance"]
         
-        dynamo.update(self.m_user["line_mid"], "m_user", "docomo_send_time", docomo_send_time)
+        self.m_user["docomo_send_time"] = docomo_send_time
+        write_behind.update(self.m_user["line_mid"], "m_user", "docomo_send_time", docomo_send_time)
        
         return system_text     
       
 
+class TTLCache:
+    # size-bounded LRU whose entries expire after ttl seconds
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is None or entry[0] < time.time():
+                self.items.pop(key, None)
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = (time.time() + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def patch(self, key, attributes):
+        # applies a write we just made instead of dropping the entry
+        with self.lock:
+            entry = self.items.get(key)
+            if entry:
+                entry[1].update(copy.deepcopy(attributes))
+
+    def invalidate(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {"size":len(self.items), "hits":self.hits, "misses":self.misses}
+
+
+class WriteBehind:
+    # coalesces per-user attribute writes and sends them once, after the reply went out
+
+    def __init__(self):
+        self.updates = {}
+        self.lock = threading.Lock()
+
+    def update(self, line_mid, table, key, value):
+        with self.lock:
+            self.updates.setdefault((table, line_mid), {})[key] = value
+        # later reads in the same invocation must see the value before it is flushed
+        if table == "m_user":
+            dynamo.m_user_cache.patch(line_mid, {key:value})
+
+    def flush(self):
+        with self.lock:
+            updates, self.updates = self.updates, {}
+
+        for (table, line_mid), attributes in updates.items():
+            try:
+                dynamo.update(line_mid, table, attributes)
+            except Exception:
+                logger.exception("[WRITE_BEHIND_FAILED]:{{tbl:{},line_mid:{}}}".format(table, line_mid))
+
+
 class DynamoDB:
     
     def __init__(self):
-        self.con = None
+        # boto3 resources are not thread safe, so each worker thread gets its own
+        self.local = threading.local()
+        self.m_user_cache = TTLCache(M_USER_CACHE_SIZE, M_USER_CACHE_TTL)
+
+    @property
+    def con(self):
+        return getattr(self.local, "con", None)
 
     def __connect_if_not(self):        
         if not self.con:
             self.__connect()     
         
     def __connect(self):
-        self.con = boto3.resource(
+        # the default boto3 session is not thread safe, so each thread gets its own session too
+        self.local.con = boto3.session.Session().resource(
                      'dynamodb',
                      aws_access_key_id=AWS_BOTO3_ACCESS_KEY,
                      aws_secret_access_key=AWS_BOTO3_SECRET_KEY,
                      region_name=AWS_REGION)
             
-    def get_m_user(self, line_mid):
+    def get_m_user(self, line_mid, use_cache=True):
+        # cached items live across invocations of a warm container; callers get their own copy
+        if use_cache:
+            item = self.m_user_cache.get(line_mid)
+            if item:
+                return copy.deepcopy(item)
+
         self.__connect_if_not()        
         table = self.con.Table("m_user")
-        res = table.get_item(Key={"line_mid":line_mid})
-        return res.get("Item")
+        with tracer.span("dynamo.get_item", tbl="m_user"):
+            res = table.get_item(Key={"line_mid":line_mid})
+        item = from_dynamo(res.get("Item"))
+        
+        # unregistered users are not cached, they may register from another container
+        if item:
+            self.m_user_cache.put(line_mid, copy.deepcopy(item))
+        return item
 
     def put_user(self, item):
         self.__connect_if_not()        
         table = self.con.Table("m_user")
-        item = convert_to_decimal(item)
-        logger.info("[DYNAMO_PUT]:{}".format(item))
-        table.put_item(Item=item)
+        self.m_user_cache.invalidate(item["line_mid"])
+        logger.info("[DYNAMO_PUT]:{tbl:m_user,line_mid:%s}", item["line_mid"])
+        with tracer.span("dynamo.put_item", tbl="m_user"):
+            table.put_item(Item=to_dynamo(item))
             
     def batch_write(self, table_name, items):
         self.__connect_if_not()        
         table = self.con.Table(table_name)
 
-        with table.batch_writer() as batch:
-            for item in items:
-                item = convert_to_decimal(item)
-                batch.put_item(Item=item)
-        logger.info("[DYNAMO_BATCH_WRITE]:{{tbl_name:{},items:{}}}".format(table_name,items))
+        with tracer.span("dynamo.batch_write", tbl=table_name, cnt=len(items)):
+            with table.batch_writer() as batch:
+                for item in items:
+                    batch.put_item(Item=to_dynamo(item))
+        logger.info("[DYNAMO_BATCH_WRITE]:{tbl_name:%s,item_cnt:%s}", table_name, len(items))
         
     def query_by_datetime(self, line_mid, table_name, datetime_key, datetime_str):
+        from boto3.dynamodb.conditions import Key
         self.__connect_if_not()       
         table = self.con.Table(table_name)
 
-        res = table.query(
-            KeyConditionExpression=Key("line_mid").eq(line_mid) & Key(datetime_key).gte(datetime_str), 
-        )
-        items = res["Items"]
-        logger.info("[DYNAMO_QUERY]:{{tbl:{},line_mid:{},{}:{},result_cnt:{}}}".format(table_name, line_mid, datetime_key, datetime_str, len(items)))
+        with tracer.span("dynamo.query", tbl=table_name):
+            res = table.query(
+                KeyConditionExpression=Key("line_mid").eq(line_mid) & Key(datetime_key).gte(datetime_str), 
+            )
+        items = from_dynamo(res["Items"])
+        logger.info("[DYNAMO_QUERY]:{tbl:%s,line_mid:%s,%s:%s,result_cnt:%s}", table_name, line_mid, datetime_key, datetime_str, len(items))
 
         return items
+
+    def query_latest(self, line_mid, table_name, limit):
+        # the newest limit rows by sort key, returned in ascending order
+        from boto3.dynamodb.conditions import Key
+        self.__connect_if_not()       
+        table = self.con.Table(table_name)
+
+        with tracer.span("dynamo.query", tbl=table_name):
+            res = table.query(
+                KeyConditionExpression=Key("line_mid").eq(line_mid),
+                ScanIndexForward=False,
+                Limit=limit,
+            )
+        items = from_dynamo(res["Items"])
+        logger.info("[DYNAMO_QUERY]:{tbl:%s,line_mid:%s,limit:%s,result_cnt:%s}", table_name, line_mid, limit, len(items))
+
+        return items[::-1]
         
-    def update(self, line_mid, table, key, value):
+    def update(self, line_mid, table, attributes):
+        # sets every attribute in one UpdateExpression
         self.__connect_if_not()        
         table = self.con.Table(table)
         
-        res = table.update_item(
-            Key={"line_mid": line_mid},
-            UpdateExpression="set {} = :c".format(key),
-            ExpressionAttributeValues={
-                    ":c": value
-            },
-            ReturnValues="UPDATED_NEW"
-        )
+        keys = list(attributes)
+        with tracer.span("dynamo.update_item", tbl=table.name):
+            res = table.update_item(
+                Key={"line_mid": line_mid},
+                UpdateExpression="set " + ", ".join("#k{0} = :v{0}".format(i) for i in range(len(keys))),
+                ExpressionAttributeNames={"#k{}".format(i):key for i, key in enumerate(keys)},
+                ExpressionAttributeValues={":v{}".format(i):to_dynamo(attributes[key]) for i, key in enumerate(keys)},
+                ReturnValues="UPDATED_NEW"
+            )
         
         status_code = res["ResponseMetadata"]["HTTPStatusCode"]
         request_id = res["ResponseMetadata"]["RequestId"]
@@ -182,144 +487,552 @@ class DynamoDB:
         if status_code != 200:
             log_error(4, "RequestId:{}".format(request_id))
 
-        logger.info("[DYNAMO_UPDATE]:{{tbl:{},line_mid:{},{}:{}}}".format(table, line_mid, key, value))
+        if table.name == "m_user":
+            self.m_user_cache.patch(line_mid, attributes)
 
+        logger.info("[DYNAMO_UPDATE]:{tbl:%s,line_mid:%s,attributes:%s}", table.name, line_mid, keys)
 
-    def scan_m_user(self):        
+
+    def update_token(self, line_mid, token, previous_refresh_token):
+        # only the invocation still holding the previous refresh token may store the rotated one
         self.__connect_if_not()        
         table = self.con.Table("m_user")
+        self.m_user_cache.invalidate(line_mid)
         
-        res = table.scan()
-        
-        items = res["Items"]
-        line_mids = [item["line_mid"] for item in items]        
+        try:
+            with tracer.span("dynamo.update_item", tbl="m_user", token=True):
+                table.update_item(
+                    Key={"line_mid": line_mid},
+                    UpdateExpression="set access_token = :a, refresh_token = :r, expires_in = :e, token_issued_at = :t",
+                    ConditionExpression="refresh_token = :p",
+                    ExpressionAttributeValues=to_dynamo({
+                            ":a": token["access_token"],
+                            ":r": token["refresh_token"],
+                            ":e": token["expires_in"],
+                            ":t": token["token_issued_at"],
+                            ":p": previous_refresh_token,
+                    }),
+                )
+        except self.con.meta.client.exceptions.ConditionalCheckFailedException:
+            logger.info("[DYNAMO_UPDATE]:{tbl:m_user,line_mid:%s,token:conflict}", line_mid)
+            return False
+
+        logger.info("[DYNAMO_UPDATE]:{tbl:m_user,line_mid:%s,token:refreshed}", line_mid)
+        return True
+
+    def get_fitbit_cache(self, line_mid, cache_key):
+        self.__connect_if_not()        
+        table = self.con.Table("tbl_fitbit_cache")
+        with tracer.span("dynamo.get_item", tbl="tbl_fitbit_cache"):
+            res = table.get_item(Key={"line_mid":line_mid, "cache_key":cache_key})
+        return from_dynamo(res.get("Item"))
+
+    def put_fitbit_cache(self, item):
+        self.__connect_if_not()        
+        table = self.con.Table("tbl_fitbit_cache")
+        with tracer.span("dynamo.put_item", tbl="tbl_fitbit_cache"):
+            table.put_item(Item=to_dynamo(item))
+        logger.info("[DYNAMO_PUT]:{tbl:tbl_fitbit_cache,line_mid:%s,cache_key:%s}", item["line_mid"], item["cache_key"])
+
+    def claim(self, line_mid, idempotency_key, ttl=IDEMPOTENCY_TTL):
+        # True only for the first caller of a key until it expires after ttl seconds;
+        # the table's TTL on expires_at deletes items lazily, so expiry is also checked here
+        self.__connect_if_not()        
+        table = self.con.Table("tbl_idempotency")
+        now = int(time.time())
+
+        try:
+            with tracer.span("dynamo.put_item", tbl="tbl_idempotency"):
+                table.put_item(Item={"line_mid":line_mid,
+                                     "idempotency_key":idempotency_key,
+                                     "expires_at":now + ttl},
+                               ConditionExpression="attribute_not_exists(idempotency_key) OR expires_at < :now",
+                               ExpressionAttributeValues={":now":now})
+        except self.con.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def extend(self, line_mid, idempotency_key, ttl=IDEMPOTENCY_TTL):
+        # keeps a key the caller already claimed for ttl seconds from now
+        self.__connect_if_not()        
+        table = self.con.Table("tbl_idempotency")
+        with tracer.span("dynamo.put_item", tbl="tbl_idempotency"):
+            table.put_item(Item={"line_mid":line_mid,
+                                 "idempotency_key":idempotency_key,
+                                 "expires_at":int(time.time()) + ttl})
+
+    def release(self, line_mid, idempotency_key):
+        self.__connect_if_not()        
+        table = self.con.Table("tbl_idempotency")
+        with tracer.span("dynamo.delete_item", tbl="tbl_idempotency"):
+            table.delete_item(Key={"line_mid":line_mid, "idempotency_key":idempotency_key})
+
+    def record_shard(self, run_id, segment, total_segments, summary):
+        # adds a shard's counts to its run once; returns the updated run, or None for a repeated shard
+        self.__connect_if_not()        
+        table = self.con.Table("tbl_predict_runs")
+
+        try:
+            with tracer.span("dynamo.update_item", tbl="tbl_predict_runs"):
+                res = table.update_item(
+                    Key={"run_id":run_id},
+                    UpdateExpression="ADD done_shards :s, #u :u, succeeded :o, failed :f, skipped :k SET total_segments = :t",
+                    ConditionExpression="attribute_not_exists(done_shards) OR NOT contains(done_shards, :segment)",
+                    ExpressionAttributeNames={"#u":"users"},
+                    ExpressionAttributeValues={":s":{segment},
+                                               ":segment":segment,
+                                               ":u":summary["users"],
+                                               ":o":summary["succeeded"],
+                                               ":f":summary["failed"],
+                                               ":k":summary["skipped"],
+                                               ":t":total_segments},
+                    ReturnValues="ALL_NEW",
+                )
+        except self.con.meta.client.exceptions.ConditionalCheckFailedException:
+            logger.info("[DYNAMO_UPDATE]:{tbl:tbl_predict_runs,run_id:%s,segment:%s,repeated:True}", run_id, segment)
+            return None
+
+        return from_dynamo(res["Attributes"])
+
+    def scan_m_user_segment(self, segment, total_segments, attributes=None):
+        return self.__scan_segment(attributes, segment, total_segments)
+
+    def scan_m_user(self, total_segments=1, attributes=None):
+        # yields items as pages arrive; total_segments > 1 scans segments in parallel
+        if total_segments <= 1:
+            yield from self.__scan_segment(attributes)
+            return
+
+        done = object()
+        pages = queue.Queue()
+
+        def scan_segment(segment):
+            try:
+                for item in self.__scan_segment(attributes, segment, total_segments):
+                    pages.put(item)
+            except Exception as e:
+                pages.put(e)
+            finally:
+                pages.put(done)
+
+        with ThreadPoolExecutor(max_workers=total_segments) as executor:
+            for segment in range(total_segments):
+                executor.submit(scan_segment, segment)
+
+            remaining = total_segments
+            while remaining:
+                item = pages.get()
+                if item is done:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+
+    def __scan_segment(self, attributes=None, segment=None, total_segments=None):
+        self.__connect_if_not()        
+        table = self.con.Table("m_user")
+
+        kwargs = {}
+        if attributes:
+            names = {"#a{}".format(i):attribute for i, attribute in enumerate(attributes)}
+            kwargs["ProjectionExpression"] = ",".join(names)
+            kwargs["ExpressionAttributeNames"] = names
+        if total_segments:
+            kwargs["Segment"] = segment
+            kwargs["TotalSegments"] = total_segments
         
-        logger.info("[DYNAMO_SCAN]:{{tbl:m_user,line_mids:{}}}".format(line_mids))
+        while True:
+            with tracer.span("dynamo.scan", tbl="m_user", segment=segment):
+                res = table.scan(**kwargs)
+            items = from_dynamo(res["Items"])
+            logger.info("[DYNAMO_SCAN]:{tbl:m_user,segment:%s,result_cnt:%s}", segment, len(items))
+            yield from items
+
+            if "LastEvaluatedKey" not in res:
+                break
+            kwargs["ExclusiveStartKey"] = res["LastEvaluatedKey"]
+
+
+class MemoryCacheBackend:
+    
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get(self, line_mid, cache_key):
+        with self.lock:
+            return self.items.get((line_mid, cache_key))
+
+    def put(self, item):
+        with self.lock:
+            self.items[(item["line_mid"], item["cache_key"])] = item
+
+
+class DynamoCacheBackend:
+
+    def get(self, line_mid, cache_key):
+        return dynamo.get_fitbit_cache(line_mid, cache_key)
+
+    def put(self, item):
+        dynamo.put_fitbit_cache(item)
+
+
+class FitbitCache:
+    
+    BACKENDS = {"memory":MemoryCacheBackend, "dynamo":DynamoCacheBackend}
+
+    def __init__(self, backend, ttl=FITBIT_CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+
+    @classmethod
+    def from_setting(cls, name):
+        if name not in cls.BACKENDS:
+            return None
+        return cls(cls.BACKENDS[name]())
+
+    def fetch(self, line_mid, resource, base_date, end_date, request, clock):
+        # cache errors never fail the fetch, the request is made directly instead
+        cache_key = "{}|{}|{}".format(resource, base_date, end_date)
         
-        return items
+        try:
+            item = self.backend.get(line_mid, cache_key)
+        except Exception:
+            logger.exception("[FITBIT_CACHE_FAILED]:{}".format(cache_key))
+            item = None
+        if item and self.__is_fresh(item, end_date, clock):
+            logger.info("[FITBIT_CACHE]:{hit:True,line_mid:%s,cache_key:%s}", line_mid, cache_key)
+            return json.loads(item["payload"])
+
+        logger.info("[FITBIT_CACHE]:{hit:False,line_mid:%s,cache_key:%s}", line_mid, cache_key)
+        payload = request()
+        now = time.time()
+        # payload is kept as a JSON string so callers always get a fresh, mutable copy;
+        # ranges ending yesterday or later still change and expire with FITBIT_CACHE_TTL
+        retention = self.ttl if end_date >= clock.yesterday_str else FITBIT_CACHE_RETENTION
+        try:
+            self.backend.put({"line_mid":line_mid,
+                              "cache_key":cache_key,
+                              "fetched_at":int(now),
+                              "payload":json.dumps(payload),
+                              "ttl":int(now + retention),
+                              })
+        except Exception:
+            logger.exception("[FITBIT_CACHE_FAILED]:{}".format(cache_key))
+        return payload
+
+    def __is_fresh(self, item, end_date, clock):
+        # days before yesterday no longer change on the Fitbit side
+        if end_date < clock.yesterday_str:
+            return True
+        return time.time() - float(item["fetched_at"]) < self.ttl
+
+
+class FitbitRateLimit:
+    
+    def __init__(self, margin=FITBIT_RATE_LIMIT_MARGIN):
+        self.margin = margin
+        self.limits = {}
+        self.lock = threading.Lock()
+
+    def record(self, line_mid, response):
+        headers = response.headers
+        if response.status_code == 429:
+            remaining = 0
+            reset = headers.get("Retry-After", headers.get("Fitbit-Rate-Limit-Reset"))
+        else:
+            remaining = headers.get("Fitbit-Rate-Limit-Remaining")
+            reset = headers.get("Fitbit-Rate-Limit-Reset")
+        if remaining is None or reset is None:
+            return
 
+        with self.lock:
+            self.limits[line_mid] = {"remaining":int(remaining), "reset_at":time.time() + int(reset)}
 
-class ExFitbit(fitbit.Fitbit):
+    def backoff_seconds(self, line_mid):
+        with self.lock:
+            limit = self.limits.get(line_mid)
+        if not limit or limit["remaining"] > self.margin:
+            return 0
+        return max(0, limit["reset_at"] - time.time())
+
+
+class ExFitbit:
     
     TBL_ACTIVITIES = ["calories","caloriesBMR","steps","distance","minutesSedentary","minutesLightlyActive","minutesFairlyActive","minutesVeryActive","activityCalories"]
     
-    def __init__(self, m_user):
-        super().__init__(FITBIT_CLIENT_ID,
-                         FITBIT_CLIENT_SECRET,
-                         access_token=m_user["access_token"],
-                         refresh_token=m_user["refresh_token"],
-                         refresh_cb=self.refresh_cb)
+    def __init__(self, m_user, clock):
+        # wraps fitbit.Fitbit instead of subclassing it so the module imports without fitbit
         self.m_user = m_user
-        self.client.refresh_token()
+        self.clock = clock
+        self.changed = {}
+        self.api = fitbit.Fitbit(FITBIT_CLIENT_ID,
+                                 FITBIT_CLIENT_SECRET,
+                                 access_token=m_user["access_token"],
+                                 refresh_token=m_user["refresh_token"],
+                                 refresh_cb=self.refresh_cb)
+        self.client = self.api.client
+        self.api.API_ENDPOINT = FITBIT_API_ENDPOINT
+        self.client.API_ENDPOINT = FITBIT_API_ENDPOINT
+        self.client.refresh_token_url = FITBIT_API_ENDPOINT + "/oauth2/token"
+        self.__mount_session_pool()
+        self.client.session.hooks["response"].append(self.__record_rate_limit)
+        if self.__is_token_expired():
+            self.__refresh_token()
+
+    def __is_token_expired(self):
+        # users registered before token_issued_at was stored are refreshed once
+        if "token_issued_at" not in self.m_user:
+            return True
+        expires_at = float(self.m_user["token_issued_at"]) + float(self.m_user["expires_in"])
+        return time.time() > expires_at - FITBIT_TOKEN_REFRESH_MARGIN
+
+    def __request(self, method, *args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except fitbit.exceptions.HTTPUnauthorized:
+            logger.info("[FITBIT]:unauthorized, refresh token {}".format(self.m_user["line_mid"]))
+            self.__refresh_token()
+            return method(*args, **kwargs)
+
+    def __refresh_token(self):
+        with tracer.span("fitbit.refresh_token"):
+            self.client.refresh_token()
+
+    def __mount_session_pool(self):
+        # concurrent time_series calls share keep-alive connections of one session
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(FITBIT_ACTIVITY_WORKERS, 10))
+        self.client.session.mount("https://", adapter)
         
+    def __record_rate_limit(self, response, *args, **kwargs):
+        fitbit_rate_limit.record(self.m_user["line_mid"], response)
+
+    def time_series(self, resource, user_id=None, base_date='today', period=None, end_date=None):
+        if not end_date:
+            return self.__time_series(resource, user_id, base_date, period, end_date)
+        return concat_responses([self.__time_series(resource, user_id, chunk_base, None, chunk_end)
+                                 for chunk_base, chunk_end in date_chunks(base_date, end_date, FITBIT_MAX_SPANS.get(resource, FITBIT_MAX_SPAN))])
+
+    def __time_series(self, resource, user_id, base_date, period, end_date):
+        def request():
+            with tracer.span("fitbit.time_series", resource=resource):
+                return self.__request(self.api.time_series, resource, user_id=user_id, base_date=base_date, period=period, end_date=end_date)
+        if not fitbit_cache or not end_date:
+            return request()
+        return fitbit_cache.fetch(self.m_user["line_mid"], resource, base_date, end_date, request, self.clock)
+
+    def get_sleep_range(self, base_date, end_date):
+        return concat_responses([self.__get_sleep_range(chunk_base, chunk_end)
+                                 for chunk_base, chunk_end in date_chunks(base_date, end_date, FITBIT_MAX_SPANS["sleep"])])
+
+    def __get_sleep_range(self, base_date, end_date):
+        def request():
+            with tracer.span("fitbit.get_sleep_range"):
+                sleeps = self.__request(self.api.get_sleep_range, base_date, end_date)
+            # minuteData is never stored and would blow up cached items
+            for sleep in sleeps["sleep"]:
+                sleep.pop("minuteData", None)
+            return sleeps
+        if not fitbit_cache:
+            return request()
+        return fitbit_cache.fetch(self.m_user["line_mid"], "sleep", base_date, end_date, request, self.clock)
+
+    def get_last_sync_time(self):
+        # newest lastSyncTime over the user's devices, None without devices
+        with tracer.span("fitbit.devices"):
+            devices = self.__request(self.api.get_devices)
+        return max((device["lastSyncTime"] for device in devices if device.get("lastSyncTime")), default=None)
+
     def refresh_cb(self, token):
         logger.info("[FITBIT]:refresh token {}".format(self.m_user["line_mid"]))
-        FitbitAuthController(self.m_user["line_mid"]).register(token)
+        token = dict(token, token_issued_at=int(time.time()))
+        
+        if not dynamo.update_token(self.m_user["line_mid"], token, self.m_user["refresh_token"]):
+            # a concurrent invocation rotated the token first, so continue with the stored one
+            token = dynamo.get_m_user(self.m_user["line_mid"], use_cache=False)
+            self.client.session.token = dict(self.client.session.token,
+                                             access_token=token["access_token"],
+                                             refresh_token=token["refresh_token"])
+
+        for key in ["access_token","refresh_token","expires_in","token_issued_at"]:
+            self.m_user[key] = token[key]
         
-    def get_tbl_sleep(self):        
-        query_datetime = DATETIME_NOW.replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=BASE_PERIOD)
-        return dynamo.query_by_datetime(self.m_user["line_mid"], "tbl_sleep", "endTime", query_datetime.strftime("%Y-%m-%dT00:00:00.000"))
+    def __query_date_str(self, since=None):
+        return since or self.clock.date_str(HISTORY_PERIOD)
 
-    def update_tbl_sleep(self):
+    def get_tbl_sleep(self, since=None):        
+        query_date_str = self.__query_date_str(since)
+        return dynamo.query_by_datetime(self.m_user["line_mid"], "tbl_sleep", "endTime", query_date_str + "T00:00:00.000")
+
+    def update_tbl_sleep(self, since=None, base_date=None, end_date=None):
     
-        query_datetime = DATETIME_NOW.replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=BASE_PERIOD)
-        tbl_sleep = self.get_tbl_sleep()
+        # base_date and end_date fetch a fixed range instead of continuing from the newest stored day
+        query_date_str = self.__query_date_str(since)
+        tbl_sleep = self.get_tbl_sleep(since)
         
-        if len(tbl_sleep) == 0:
-            sleeps = self.get_sleep_range(query_datetime.strftime("%Y-%m-%d"), DATETIME_NOW.strftime("%Y-%m-%d"))
+        if base_date:
+            sleeps = self.get_sleep_range(base_date, end_date)
+
+        elif len(tbl_sleep) == 0:
+            sleeps = self.get_sleep_range(query_date_str, self.clock.today_str)
         
         else:
-            df_sleep = pd.DataFrame.from_dict(tbl_sleep)
-            max_dateOfSleep = df_sleep["dateOfSleep"].max()
-            sleeps = self.get_sleep_range(max_dateOfSleep, DATETIME_NOW.strftime("%Y-%m-%d"))
+            max_dateOfSleep = max(sleep["dateOfSleep"] for sleep in tbl_sleep)
+            sleeps = self.get_sleep_range(max_dateOfSleep, self.clock.today_str)
         
-        items = []
         for sleep in sleeps["sleep"]:
-            del sleep["minuteData"]
+            sleep.pop("minuteData", None)
             sleep["line_mid"] = self.m_user["line_mid"]
-            if sleep not in tbl_sleep:
-                items.append(sleep)
-                tbl_sleep.append(sleep)
+        items = merge_rows(tbl_sleep, sleeps["sleep"], "logId")
+        self.changed["tbl_sleep"] = items
             
         if len(items) > 0:
             dynamo.batch_write("tbl_sleep", items)
         
         return tbl_sleep
                          
-    def get_tbl_heart(self):       
-        query_datetime = DATETIME_NOW.replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=BASE_PERIOD)
-        return dynamo.query_by_datetime(self.m_user["line_mid"], "tbl_heart", "dateTime", query_datetime.strftime("%Y-%m-%d"))
+    def get_tbl_heart(self, since=None):       
+        query_date_str = self.__query_date_str(since)
+        return dynamo.query_by_datetime(self.m_user["line_mid"], "tbl_heart", "dateTime", query_date_str)
 
-    def update_tbl_heart(self):
+    def update_tbl_heart(self, since=None, base_date=None, end_date=None):
     
-        query_datetime = DATETIME_NOW.replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=BASE_PERIOD)
-        tbl_heart = self.get_tbl_heart()
+        query_date_str = self.__query_date_str(since)
+        tbl_heart = self.get_tbl_heart(since)
         
-        if len(tbl_heart) == 0:
-            hearts = self.time_series("activities/heart", base_date=query_datetime.strftime("%Y-%m-%d"), end_date=DATETIME_NOW.strftime("%Y-%m-%d"))
+        if base_date:
+            hearts = self.time_series("activities/heart", base_date=base_date, end_date=end_date)
+
+        elif len(tbl_heart) == 0:
+            hearts = self.time_series("activities/heart", base_date=query_date_str, end_date=self.clock.today_str)
         
         else:
-            df_heart = pd.DataFrame.from_dict(tbl_heart)
-            max_dateTime = df_heart["dateTime"].max()
-            hearts = self.time_series("activities/heart", base_date=max_dateTime, end_date=DATETIME_NOW.strftime("%Y-%m-%d"))
+            max_dateTime = max(heart["dateTime"] for heart in tbl_heart)
+            hearts = self.time_series("activities/heart", base_date=max_dateTime, end_date=self.clock.today_str)
         
-        items = []
         for heart in hearts["activities-heart"]:
             heart["line_mid"] = self.m_user["line_mid"]
-            if heart not in tbl_heart:
-                items.append(heart)
-                tbl_heart.append(heart)
+        items = merge_rows(tbl_heart, hearts["activities-heart"], "dateTime")
+        self.changed["tbl_heart"] = items
         
         if len(items) > 0:
             dynamo.batch_write("tbl_heart", items)
 
         return tbl_heart
         
-    def get_tbl_activities(self):
-        query_datetime = DATETIME_NOW.replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=BASE_PERIOD)
-        return dynamo.query_by_datetime(self.m_user["line_mid"], "tbl_activities", "dateTime", query_datetime.strftime("%Y-%m-%d"))
+    def get_tbl_activities(self, since=None):
+        query_date_str = self.__query_date_str(since)
+        return dynamo.query_by_datetime(self.m_user["line_mid"], "tbl_activities", "dateTime", query_date_str)
 
     def __get_activity_items(self, activity_names, base_date, end_date):
         
-        df = pd.DataFrame()
-        for name in activity_names:
-            res = self.time_series("activities/{}".format(name),base_date=base_date,end_date=end_date)
-            tmp = pd.DataFrame(res["activities-{}".format(name)]).rename(columns={"value":name})
-            if df.shape[1] == 0:
-                df = tmp.copy()
-            else:
-                df = df.merge(tmp, on="dateTime") 
-        df["line_mid"] = self.m_user["line_mid"]            
-        items = df.to_dict(orient="records")
+        with ThreadPoolExecutor(max_workers=FITBIT_ACTIVITY_WORKERS) as executor:
+            series = list(executor.map(lambda name: self.__get_activity_series(name, base_date, end_date), activity_names))
+
+        # join all series on dateTime in one pass, keeping only dates every series has
+        columns = {}
+        for name, records in zip(activity_names, series):
+            for record in records:
+                columns.setdefault(record["dateTime"], {})[name] = record["value"]
+
+        items = []
+        for date_str in sorted(columns):
+            values = columns[date_str]
+            if len(values) < len(activity_names):
+                continue
+            item = {"dateTime":date_str}
+            item.update(values)
+            item["line_mid"] = self.m_user["line_mid"]
+            items.append(item)
         
         return items
 
-    def update_tbl_activities(self):
+    def __get_activity_series(self, name, base_date, end_date):
+        
+        res = self.time_series("activities/{}".format(name),base_date=base_date,end_date=end_date)
+        return res["activities-{}".format(name)]
+
+    def update_tbl_activities(self, since=None, base_date=None, end_date=None):
     
-        query_datetime = DATETIME_NOW.replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=BASE_PERIOD)
-        tbl_activities = self.get_tbl_activities()
+        query_date_str = self.__query_date_str(since)
+        tbl_activities = self.get_tbl_activities(since)
         
-        if len(tbl_activities) == 0:
-            items = self.__get_activity_items(self.TBL_ACTIVITIES, query_datetime.strftime("%Y-%m-%d"), DATETIME_NOW.strftime("%Y-%m-%d"))
+        if base_date:
+            items = self.__get_activity_items(self.TBL_ACTIVITIES, base_date, end_date)
+
+        elif len(tbl_activities) == 0:
+            items = self.__get_activity_items(self.TBL_ACTIVITIES, query_date_str, self.clock.today_str)
             
         else:
-            df_activities = pd.DataFrame.from_dict(tbl_activities)
-            max_dateTime = df_activities["dateTime"].max()
-            items = self.__get_activity_items(self.TBL_ACTIVITIES, max_dateTime, DATETIME_NOW.strftime("%Y-%m-%d"))
-            
-            items = [item for item in items if item not in tbl_activities]
-            for item in items:
-                if item["dateTime"] == max_dateTime:
-                    tbl_activities = [item for item in tbl_activities if item["dateTime"] != max_dateTime]
-                    break
+            max_dateTime = max(activity["dateTime"] for activity in tbl_activities)
+            items = self.__get_activity_items(self.TBL_ACTIVITIES, max_dateTime, self.clock.today_str)
 
-        tbl_activities.extend(items)
+        items = merge_rows(tbl_activities, items, "dateTime")
+        self.changed["tbl_activities"] = items
 
         if len(items) > 0:
             dynamo.batch_write("tbl_activities", items)
 
         return tbl_activities
 
+    def update_tbl_daily_features(self, tbl_sleep, tbl_heart, tbl_activities, all_dates=False):
+        # rewrites the features of every date the update_tbl_* calls touched, from the merged tables
+        dates = {row.get("dateOfSleep", row.get("dateTime")) for rows in self.changed.values() for row in rows}
+        features = [feature for feature in daily_features(tbl_sleep, tbl_heart, tbl_activities)
+                    if all_dates or feature["dateTime"] in dates]
+        self.changed = {}
+
+        if DAILY_FEATURES_ENABLED and len(features) > 0:
+            dynamo.batch_write("tbl_daily_features", features)
+
+        return features
+
+
+def date_chunks(base_date, end_date, max_days):
+    # consecutive (base, end) ranges of at most max_days days covering base_date..end_date
+    base = datetime.datetime.strptime(base_date, "%Y-%m-%d")
+    end = datetime.datetime.strptime(end_date, "%Y-%m-%d")
+    chunks = []
+    while base <= end:
+        chunk_end = min(base + datetime.timedelta(days=max_days - 1), end)
+        chunks.append((base.strftime("%Y-%m-%d"), chunk_end.strftime("%Y-%m-%d")))
+        base = chunk_end + datetime.timedelta(days=1)
+    return chunks or [(base_date, end_date)]
+
+
+def concat_responses(responses):
+    # joins the lists of chunked Fitbit responses, e.g. {"sleep":[...]} or {"activities-steps":[...]}
+    if len(responses) == 1:
+        return responses[0]
+    joined = {}
+    for response in responses:
+        for key, value in response.items():
+            if isinstance(value, list):
+                joined.setdefault(key, []).extend(value)
+            else:
+                joined.setdefault(key, value)
+    return joined
+
+
+def merge_rows(rows, fetched, key):
+    # merges fetched into rows in place by natural key and returns only inserted or changed rows
+    index = {row[key]:i for i, row in enumerate(rows)}
+    
+    changed = []
+    for row in fetched:
+        i = index.get(row[key])
+        if i is None:
+            index[row[key]] = len(rows)
+            rows.append(row)
+            changed.append(row)
+        # stored rows come back through from_dynamo, so plain equality holds for unchanged rows
+        elif row != rows[i]:
+            rows[i] = row
+            changed.append(row)
+    
+    return changed
+
 
 class FitbitAuthController:
     
@@ -330,7 +1043,7 @@ class FitbitAuthController:
 
         if error == "access_denied":
             text = "連携を許可してね。"
-            line_push(self.line_mid, text)
+            self.__push(text)
             return True
 
         if error:            
@@ -350,19 +1063,26 @@ class FitbitAuthController:
         if not res:
             log_error(3)
             return False        
-        logger.info("[FITBIT_AUTH_RES]:{}".format(res.content))
+        logger.info("[FITBIT_AUTH_RES]:{{status_code:{}}}".format(res.status_code))
         
         content = json.loads(res.content.decode('utf-8'))
         scopes = content["scope"].split(" ")
         if set(scopes) != set(FITBIT_SCOPES.split(" ")):
             text = "Fitbitとうまく連携できないよ。Fitbitのホームページ管理画面から後で削除もできるので、全てにチェックを入れて登録してみて。"
-            line_push(self.line_mid, text)
+            self.__push(text)
             return False
 
         self.register(content)
         text = "Fitbitと連携できたよ！「おつげ」って呼びかけてみてね。"
-        line_push(self.line_mid, text)
+        self.__push(text)
         return True
+
+    def __push(self, text):
+        # the callback's outcome does not depend on the LINE message, e.g. when retries run out
+        try:
+            line_push(self.line_mid, text)
+        except Exception:
+            logger.exception("[FITBIT_AUTH_PUSH_FAILED]:{}".format(self.line_mid))
         
             
     def __auth_request(self, code):
@@ -377,10 +1097,11 @@ class FitbitAuthController:
           ('redirect_uri', FITBIT_REDIRECT_URI),
           ('code', code),
         ]
-        url = "https://api.fitbit.com/oauth2/token"
+        url = FITBIT_API_ENDPOINT + "/oauth2/token"
 
-        logger.info("[FITBIT_AUTH_REQ]:{{url:{},headers:{},data:{}}}".format(url,headers,data))    
-        return requests.post(url, data=data, headers=headers) 
+        logger.info("[FITBIT_AUTH_REQ]:{{url:{}}}".format(url))    
+        with tracer.span("fitbit.oauth2_token"):
+            return http_session().post(url, data=data, headers=headers, timeout=HTTP_TIMEOUT)
         
     
     def register(self, content):
@@ -391,9 +1112,15 @@ class FitbitAuthController:
                   "refresh_token":content["refresh_token"],
                   "scope":content["scope"],
                   "expires_in":content["expires_in"],
+                  "token_issued_at":int(time.time()),
                   }
         dynamo.put_user(m_user)
 
+        try:
+            dispatcher().dispatch({"BackfillHistory":{"line_mids":[self.line_mid]}})
+        except Exception:
+            logger.exception("[BACKFILL_HISTORY_DISPATCH_FAILED]:{}".format(self.line_mid))
+
 
 class Model:
     
@@ -447,17 +1174,22 @@ class Model:
 "4141":"ここ何日かいつもと違うペースですね。旅行とかですか？いつもやっていることも新鮮な気持ちでみてみよう。疲れまだ残っているみたいなので回復もしてね"
 }
     
+    WINDOW = PREDICT_WINDOW
+    TREND_WEIGHTS = [0.2,0.5,0.7,1]
+    
     def __init__(self, tbl_sleep, tbl_heart, tbl_activities,
-                 date_str=datetime.datetime.strftime(datetime.datetime.now(),"%Y-%m-%d")):
+                 date_str=None):
 
+        # tables may hold rows of many users; predict() treats them as one user
         df_sleep = self.__group_df_sleep_by_date(pd.DataFrame(tbl_sleep))
         df_heart = pd.DataFrame(tbl_heart)
         df_activities = pd.DataFrame(tbl_activities)
         df = df_sleep.merge(df_heart, on=["line_mid", "dateTime"])
         df = df.merge(df_activities, on=["line_mid", "dateTime"])
         self.df = df
+        self.date_str = date_str or Clock().today_str
         self.base_date_str = df["dateTime"].max()
-        self.is_latest = self.base_date_str == date_str
+        self.is_latest = self.base_date_str == self.date_str
 
     def __group_df_sleep_by_date(self, df):
         keys = ["line_mid","dateOfSleep"]
@@ -465,33 +1197,317 @@ class Model:
         return df[keys+cols].groupby(keys).sum().reset_index().rename(columns={"dateOfSleep":"dateTime"})
         
     def predict(self):
-                
-        df = self.df.sort_values("dateTime").reset_index(drop=True)
-        df = df.loc[len(df)-30:, ["duration","minutesLightlyActive","minutesFairlyActive","minutesVeryActive"]]
-        df = df.astype(float)
-
-        df["activity_idx"] = df["minutesLightlyActive"] + 2*df["minutesFairlyActive"] + 3*df["minutesVeryActive"]
-        df["activity_idx_avg"] = df["activity_idx"].mean()
-        df["activity_idx_std"] = df["activity_idx"].std()        
-        df["idx1"] = 4 * (df["activity_idx"] > df["activity_idx_avg"] + df["activity_idx_std"])
-        df["idx1"] = df["idx1"] + 3 * ((df["activity_idx"] > df["activity_idx_avg"]) & (df["idx1"] < 4))
-        df["idx1"] = df["idx1"] + 2 * ((df["activity_idx"] > df["activity_idx_avg"] - df["activity_idx_std"]) & (df["idx1"] < 3))
-        df["idx1"] = df["idx1"] + 1 * (df["idx1"] < 2)
-        idx1 = df["idx1"].values[-1] 
-        idx2 = 1*((df["idx1"].values[-4:]-2.5).dot(np.array([0.2,0.5,0.7,1])) > 1.5)
-        
-        df["duration_avg"] = df["duration"].mean()
-        df["duration_std"] = df["duration"].std()        
-        df["idx3"] = 4 * (df["duration"] > df["duration_avg"] + df["duration_std"])
-        df["idx3"] = df["idx3"] + 3 * ((df["duration"] > df["duration_avg"]) & (df["idx3"] < 4))
-        df["idx3"] = df["idx3"] + 2 * ((df["duration"] > df["duration_avg"] - df["duration_std"]) & (df["idx3"] < 3))
-        df["idx3"] = df["idx3"] + 1 * (df["idx3"] < 2)
-        idx3 = df["idx3"].values[-1] 
-        idx4 = 1*((df["idx3"].values[-4:]-2.5).dot(np.array([0.2,0.5,0.7,1])) > 1.5)
-        
-        idx = "{}{}{}{}".format(idx1,idx2,idx3,idx4)
-
-        return idx, self.tmp[idx]
+        
+        with tracer.span("model.predict", engine="pandas"):
+            df = self.df.assign(line_mid="")
+            return self.single(self.__predict_df(df))
+
+    def predict_by_user(self):
+        
+        base_date_strs = self.df.groupby("line_mid")["dateTime"].max()
+        self.base_date_strs = base_date_strs.to_dict()
+        self.latest_by_user = (base_date_strs == self.date_str).to_dict()
+        with tracer.span("model.predict_by_user", engine="pandas", users=len(base_date_strs)):
+            return self.__predict_df(self.df)
+
+    def __predict_df(self, df):
+        
+        # right-aligned (users x WINDOW) matrices, NaN-padded for users with less history
+        df = df.sort_values(["line_mid", "dateTime"])
+        df = df.groupby("line_mid").tail(self.WINDOW)
+        line_mids, codes = np.unique(df["line_mid"].values, return_inverse=True)
+        counts = np.bincount(codes)
+        columns = self.WINDOW - counts[codes] + df.groupby("line_mid").cumcount().values
+
+        values = df[["duration","minutesLightlyActive","minutesFairlyActive","minutesVeryActive"]].astype(float).values
+        duration = np.full((len(line_mids), self.WINDOW), np.nan)
+        duration[codes, columns] = values[:, 0]
+        activity_idx = np.full((len(line_mids), self.WINDOW), np.nan)
+        activity_idx[codes, columns] = values[:, 1] + 2*values[:, 2] + 3*values[:, 3]
+
+        return self.predict_matrices(line_mids, duration, activity_idx)
+
+    @classmethod
+    def predict_matrices(cls, line_mids, duration, activity_idx):
+        
+        # users with fewer days than the trend needs get no prediction, the original
+        # Model.predict failed on them in the trend dot product
+        idx1, idx2 = cls.levels(activity_idx)
+        idx3, idx4 = cls.levels(duration)
+        days = (~np.isnan(duration)).sum(axis=1)
+        
+        predictions = {}
+        for i, line_mid in enumerate(line_mids):
+            if days[i] < len(cls.TREND_WEIGHTS):
+                continue
+            idx = "{}{}{}{}".format(idx1[i],idx2[i],idx3[i],idx4[i])
+            predictions[line_mid] = (idx, cls.tmp[idx])
+
+        return predictions
+
+    @classmethod
+    def single(cls, predictions):
+        if "" not in predictions:
+            raise ValueError("fewer than {} days to predict from".format(len(cls.TREND_WEIGHTS)))
+        return predictions[""]
+
+    @classmethod
+    def levels(cls, values):
+        
+        avg, std = cls.__mean_std(values)
+        level = 4 * (values > avg + std)
+        level = level + 3 * ((values > avg) & (level < 4))
+        level = level + 2 * ((values > avg - std) & (level < 3))
+        level = level + 1 * (level < 2)
+        trend = 1*((level[:, -4:]-2.5).dot(np.array(cls.TREND_WEIGHTS)) > 1.5)
+
+        return level[:, -1], trend
+
+    @staticmethod
+    def __mean_std(values):
+        
+        # accumulate column by column so every row is summed in the same order
+        # no matter how many users are stacked, which keeps batch and single-user
+        # predictions bit-identical
+        mask = ~np.isnan(values)
+        filled = np.where(mask, values, 0.0)
+        count = mask.sum(axis=1)
+        
+        total = np.zeros(len(values))
+        for column in range(values.shape[1]):
+            total = total + filled[:, column]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            avg = total / count
+            deviation = np.where(mask, values - avg[:, None], 0.0)
+            square = np.zeros(len(values))
+            for column in range(values.shape[1]):
+                square = square + deviation[:, column] ** 2
+            std = np.sqrt(square / (count - 1))
+
+        return avg[:, None], std[:, None]
+
+
+class ArrayModel:
+    # same interface and results as Model, built on plain dicts and NumPy arrays instead of pandas
+    
+    def __init__(self, tbl_sleep, tbl_heart, tbl_activities,
+                 date_str=None):
+
+        self.features = daily_features(tbl_sleep, tbl_heart, tbl_activities)
+        self.date_str = date_str or Clock().today_str
+        self.base_date_str = max(feature["dateTime"] for feature in self.features)
+        self.is_latest = self.base_date_str == self.date_str
+
+    def predict(self):
+        
+        with tracer.span("model.predict", engine="numpy"):
+            return Model.single(self.__predict_features(self.features, by_user=False))
+
+    def predict_by_user(self):
+        
+        self.base_date_strs = {}
+        for feature in self.features:
+            self.base_date_strs[feature["line_mid"]] = feature["dateTime"]
+        self.latest_by_user = {line_mid:base_date_str == self.date_str for line_mid, base_date_str in self.base_date_strs.items()}
+        with tracer.span("model.predict_by_user", engine="numpy", users=len(self.base_date_strs)):
+            return self.__predict_features(self.features, by_user=True)
+
+    def __predict_features(self, features, by_user):
+        
+        # features are sorted by (line_mid, dateTime), so each user's rows are contiguous
+        if not by_user:
+            features = sorted(features, key=lambda feature: feature["dateTime"])
+        windows = {}
+        for feature in features:
+            windows.setdefault(feature["line_mid"] if by_user else "", []).append(feature)
+        
+        line_mids = sorted(windows)
+        duration = np.full((len(line_mids), Model.WINDOW), np.nan)
+        activity_idx = np.full((len(line_mids), Model.WINDOW), np.nan)
+        for i, line_mid in enumerate(line_mids):
+            window = windows[line_mid][-Model.WINDOW:]
+            duration[i, Model.WINDOW-len(window):] = [feature["duration"] for feature in window]
+            activity_idx[i, Model.WINDOW-len(window):] = [feature["minutesLightlyActive"] + 2*feature["minutesFairlyActive"] + 3*feature["minutesVeryActive"] for feature in window]
+
+        return Model.predict_matrices(line_mids, duration, activity_idx)
+
+
+MODEL_ENGINES = {"pandas":Model, "numpy":ArrayModel}
+
+
+def new_model(tbl_sleep, tbl_heart, tbl_activities, date_str):
+    return MODEL_ENGINES[PREDICT_ENGINE](tbl_sleep, tbl_heart, tbl_activities, date_str)
+
+
+def daily_features(tbl_sleep, tbl_heart, tbl_activities):
+    # the rows Model.predict uses: sleep summed per dateOfSleep, inner-joined on (line_mid, dateTime)
+    durations = {}
+    for sleep in tbl_sleep:
+        key = (sleep["line_mid"], sleep["dateOfSleep"])
+        durations[key] = durations.get(key, 0) + sleep["duration"]
+    heart_keys = {(heart["line_mid"], heart["dateTime"]) for heart in tbl_heart}
+
+    features = []
+    for activity in tbl_activities:
+        key = (activity["line_mid"], activity["dateTime"])
+        if key not in durations or key not in heart_keys:
+            continue
+        features.append({"line_mid":key[0],
+                         "dateTime":key[1],
+                         "duration":float(durations[key]),
+                         "minutesLightlyActive":float(activity["minutesLightlyActive"]),
+                         "minutesFairlyActive":float(activity["minutesFairlyActive"]),
+                         "minutesVeryActive":float(activity["minutesVeryActive"]),
+                         })
+    
+    return sorted(features, key=lambda feature: (feature["line_mid"], feature["dateTime"]))
+
+
+class RollingState:
+    
+    VERSION = 1
+
+    def __init__(self, dates=None, duration=None, activity_idx=None, updated_on=None):
+        self.dates = dates or []
+        self.duration = duration or []
+        self.activity_idx = activity_idx or []
+        self.updated_on = updated_on
+
+    @classmethod
+    def from_item(cls, item):
+        if not item or int(item.get("version", 0)) != cls.VERSION:
+            return None
+        return cls(list(item["dates"]),
+                   [float(value) for value in item["duration"]],
+                   [float(value) for value in item["activity_idx"]],
+                   item["updated_on"])
+
+    def to_item(self):
+        return to_dynamo({"version":self.VERSION,
+                          "dates":self.dates,
+                          "duration":self.duration,
+                          "activity_idx":self.activity_idx,
+                          "updated_on":self.updated_on,
+                          })
+
+    def is_stale(self, date_str):
+        if not self.dates or not self.updated_on:
+            return True
+        updated_on = datetime.datetime.strptime(self.updated_on, "%Y-%m-%d")
+        return datetime.datetime.strptime(date_str, "%Y-%m-%d") - updated_on > datetime.timedelta(days=ROLLING_STATE_MAX_AGE)
+
+    def update(self, features, date_str):
+        # upserts the days in features and keeps only the last Model.WINDOW days
+        for feature in features:
+            activity_idx = feature["minutesLightlyActive"] + 2*feature["minutesFairlyActive"] + 3*feature["minutesVeryActive"]
+            i = bisect.bisect_left(self.dates, feature["dateTime"])
+            if i < len(self.dates) and self.dates[i] == feature["dateTime"]:
+                self.duration[i] = feature["duration"]
+                self.activity_idx[i] = activity_idx
+            else:
+                self.dates.insert(i, feature["dateTime"])
+                self.duration.insert(i, feature["duration"])
+                self.activity_idx.insert(i, activity_idx)
+        
+        del self.dates[:-Model.WINDOW]
+        del self.duration[:-Model.WINDOW]
+        del self.activity_idx[:-Model.WINDOW]
+        self.updated_on = date_str
+
+    def predict(self, date_str):
+        
+        duration = np.full((1, Model.WINDOW), np.nan)
+        duration[0, Model.WINDOW-len(self.duration):] = self.duration
+        activity_idx = np.full((1, Model.WINDOW), np.nan)
+        activity_idx[0, Model.WINDOW-len(self.activity_idx):] = self.activity_idx
+
+        prediction = Model.single(Model.predict_matrices([""], duration, activity_idx))
+        base_date_str = self.dates[-1]
+
+        return prediction, base_date_str, base_date_str == date_str
+
+
+class ColumnarHistory:
+    # one user's daily features for one period (a year) as zlib-compressed float64 columns;
+    # the first column holds the date as a proleptic ordinal, the others FEATURES in that order
+    
+    VERSION = 1
+    FEATURES = ["duration","minutesLightlyActive","minutesFairlyActive","minutesVeryActive"]
+
+    def __init__(self, line_mid, period, values=None):
+        self.line_mid = line_mid
+        self.period = period
+        self.values = values if values is not None else np.zeros((len(self.FEATURES) + 1, 0))
+
+    @staticmethod
+    def period_of(date_str):
+        return date_str[:4]
+
+    @staticmethod
+    def ordinal(date_str):
+        return datetime.datetime.strptime(date_str, "%Y-%m-%d").toordinal()
+
+    @staticmethod
+    def date_str(ordinal):
+        return datetime.date.fromordinal(int(ordinal)).strftime("%Y-%m-%d")
+
+    @classmethod
+    def from_item(cls, item):
+        if not item or int(item.get("version", 0)) != cls.VERSION or list(item["features"]) != cls.FEATURES:
+            return None
+        blob = zlib.decompress(bytes(getattr(item["blob"], "value", item["blob"])))
+        values = np.frombuffer(blob, dtype="<f8").reshape(len(cls.FEATURES) + 1, -1)
+        return cls(item["line_mid"], item["period"], values.copy())
+
+    def to_item(self):
+        return {"line_mid":self.line_mid,
+                "period":self.period,
+                "version":self.VERSION,
+                "features":self.FEATURES,
+                "days":self.values.shape[1],
+                "blob":zlib.compress(self.values.astype("<f8").tobytes()),
+                }
+
+    @property
+    def last_date_str(self):
+        return self.date_str(self.values[0, -1]) if self.values.shape[1] else None
+
+    def update(self, features):
+        # upserts daily_features rows, keeping the columns sorted by date
+        new = np.array([[self.ordinal(feature["dateTime"]) for feature in features]] +
+                       [[float(feature[name]) for feature in features] for name in self.FEATURES])
+        values = np.concatenate([self.values, new], axis=1)
+        # unique over the reversed dates picks the last occurrence, so new rows replace stored ones
+        _, index = np.unique(values[0][::-1], return_index=True)
+        self.values = values[:, values.shape[1] - 1 - index]
+
+    @classmethod
+    def upsert(cls, histories, line_mid, features):
+        # histories maps period to ColumnarHistory and is updated in place; returns the changed ones
+        by_period = {}
+        for feature in features:
+            by_period.setdefault(cls.period_of(feature["dateTime"]), []).append(feature)
+
+        changed = []
+        for period, period_features in sorted(by_period.items()):
+            history = histories.setdefault(period, cls(line_mid, period))
+            history.update(period_features)
+            changed.append(history)
+        return changed
+
+    @classmethod
+    def predict(cls, histories, date_str):
+        
+        values = np.concatenate([histories[period].values for period in sorted(histories)], axis=1)[:, -Model.WINDOW:]
+        duration = np.full((1, Model.WINDOW), np.nan)
+        duration[0, Model.WINDOW-values.shape[1]:] = values[1]
+        activity_idx = np.full((1, Model.WINDOW), np.nan)
+        activity_idx[0, Model.WINDOW-values.shape[1]:] = values[2] + 2*values[3] + 3*values[4]
+
+        prediction = Model.single(Model.predict_matrices([""], duration, activity_idx))
+        base_date_str = cls.date_str(values[0, -1])
+
+        return prediction, base_date_str, base_date_str == date_str
 
 
 ##############################        
@@ -499,23 +1515,63 @@ class Model:
 def lambda_handler(event, context):
     
     logger.info(event)
+    tracer.start()
 
-    return event_handler(event)
+    try:
+        return event_handler(event, Clock())
+    finally:
+        write_behind.flush()
+        logger.info("[M_USER_CACHE]:%s", LazyJson(dynamo.m_user_cache.stats()))
+        tracer.flush()
 
 
-def event_handler(event):
+def event_handler(event, clock=None):
+    
+    clock = clock or Clock()
     
     # from CloudWatch
     cloud_watch_event = event.get("CloudWatchEvent")
     if cloud_watch_event:
-        predict_all()
+        if PREDICT_SHARDS > 1:
+            dispatch_predict_shards(clock)
+        else:
+            predict_all(clock)
         return
+
+    # from line_event_handler
+    predict_request = event.get("PredictRequest")
+    if predict_request:
+        handle_predict_request(predict_request)
+        return
+
+    # from dispatch_predict_shards
+    shard = event.get("PredictShard")
+    if shard:
+        predict_shard(shard)
+        return
+    
+    # manual, e.g. aws lambda invoke --payload '{"BackfillDailyFeatures":{"line_mids":[...]}}'
+    backfill = event.get("BackfillDailyFeatures")
+    if backfill:
+        line_mids = backfill.get("line_mids") if isinstance(backfill, dict) else None
+        return backfill_daily_features(line_mids)
+
+    # manual, once before switching to PREDICT_SOURCE=columnar
+    migrate = event.get("MigrateColumnarHistory")
+    if migrate:
+        line_mids = migrate.get("line_mids") if isinstance(migrate, dict) else None
+        return migrate_columnar_history(line_mids)
+
+    # from FitbitAuthController.register, or manual like BackfillDailyFeatures
+    backfill = event.get("BackfillHistory")
+    if backfill:
+        line_mids = backfill.get("line_mids") if isinstance(backfill, dict) else None
+        return backfill_history(line_mids, clock)
     
     # from Line Post
     events = event.get("events")
     if events:        
-        for ev in events:
-            line_event_handler(ev) 
+        line_events_handler(events, clock)
         return
     
     # from Fitbit Get
@@ -530,15 +1586,329 @@ def event_handler(event):
         return
 
 
-def predict_all():
+def predict_all(clock, max_workers=PREDICT_ALL_WORKERS, m_users=None, idempotency_key=None, labels=None):
     
-    m_users = dynamo.scan_m_user()
+    # with an idempotency_key, users whose prediction was already pushed under that key are skipped
+    if m_users is None:
+        m_users = dynamo.scan_m_user(SCAN_TOTAL_SEGMENTS, M_USER_PREDICT_ATTRIBUTES)
     
-    for m_user in m_users:
-        predict(m_user)
+    # users are predicted and pushed in batches of PREDICT_BATCH_SIZE as their fetches finish,
+    # so a timeout late in the run only loses the current batch and memory stays bounded
+    results = {}
+    batch = ({}, {})
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        def collect(futures):
+            for future in futures:
+                result, user_tables, prediction = future.result()
+                results[result["line_mid"]] = result
+                if user_tables:
+                    batch[0][result["line_mid"]] = user_tables
+                if prediction:
+                    batch[1][result["line_mid"]] = prediction
+                if len(batch[0]) + len(batch[1]) >= PREDICT_BATCH_SIZE:
+                    deliver_predictions(*batch, results, clock, executor, idempotency_key)
+                    batch[0].clear()
+                    batch[1].clear()
+
+        # users are submitted while later scan pages are still loading, with a bounded number in flight
+        pending = set()
+        for m_user in m_users:
+            pending.add(executor.submit(prepare_prediction_safely, m_user, clock))
+            if len(pending) >= 2 * max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(as_completed(pending))
+        deliver_predictions(*batch, results, clock, executor, idempotency_key)
+
+    results = list(results.values())
+    log_predict_all_summary(results, labels)
+    return results
+
+
+def deliver_predictions(tables, predictions, results, clock, executor, idempotency_key=None):
+    
+    # predicts the batch's tables and pushes all of the batch's predictions
+    predictions = dict(predictions)
+    predictions.update(predict_tables(tables, results, clock))
+
+    # keys are claimed per delivery chunk right before it is sent, so a run that dies
+    # mid-flush leaves the users it did not reach unclaimed for the retry
+    claimed = {}
+    def claim(line_mid):
+        try:
+            return dynamo.claim(line_mid, idempotency_key)
+        except Exception:
+            logger.exception("[IDEMPOTENCY_CLAIM_FAILED]:{}".format(line_mid))
+            return None
+
+    def claim_chunk(chunk):
+        new = [line_mid for line_mid in chunk if line_mid not in claimed]
+        for line_mid, is_claimed in zip(new, list(executor.map(claim, new))):
+            claimed[line_mid] = is_claimed
+            if is_claimed is None:
+                results[line_mid]["ok"] = False
+            elif not is_claimed:
+                logger.info("[PREDICT_SKIPPED]:{line_mid:%s,reason:already_pushed}", line_mid)
+                results[line_mid]["skipped"] = True
+        return [line_mid for line_mid in chunk if claimed[line_mid]]
+
+    # identical messages across users go out as multicasts
+    delivery = LineDelivery()
+    for line_mid, prediction in predictions.items():
+        push_prediction(line_mid, *prediction, delivery=delivery)
+    for line_mid in delivery.flush(claim_chunk if idempotency_key else None):
+        results[line_mid]["ok"] = False
+        # a retry may push again
+        if claimed.get(line_mid):
+            dynamo.release(line_mid, idempotency_key)
+
+    # the watermark only moves once the prediction for that sync went out
+    for line_mid, prediction in predictions.items():
+        result = results[line_mid]
+        if result["ok"] and not result["skipped"] and result.get("last_sync_time"):
+            write_behind.update(line_mid, "m_user", "last_sync_time", result["last_sync_time"])
+            write_behind.update(line_mid, "m_user", "last_prediction", {"idx":prediction[0][0], "base_date_str":prediction[1]})
+    write_behind.flush()
+
+
+def dispatch_predict_shards(clock, total_segments=None):
+    
+    # one work item per m_user scan segment; all shards predict for the dispatcher's now
+    total_segments = total_segments or PREDICT_SHARDS
+    run_id = "{}#{}".format(clock.today_str, uuid.uuid4().hex[:8])
+    for segment in range(total_segments):
+        dispatcher().dispatch({"PredictShard":{"run_id":run_id,
+                                             "segment":segment,
+                                             "total_segments":total_segments,
+                                             "now":clock.now.strftime(Clock.FORMAT)}})
+    
+    logger.info("[PREDICT_DISPATCHED]:{run_id:%s,shards:%s,dispatcher:%s}", run_id, total_segments, PREDICT_DISPATCHER)
+    return run_id
+
+
+def predict_shard(shard):
+    
+    # a retried shard only pushes to users the failed attempt did not reach
+    clock = Clock(datetime.datetime.strptime(shard["now"], Clock.FORMAT))
+    labels = {"run_id":shard["run_id"], "segment":shard["segment"]}
+    m_users = dynamo.scan_m_user_segment(shard["segment"], shard["total_segments"], M_USER_PREDICT_ATTRIBUTES)
+    results = predict_all(clock, m_users=m_users, idempotency_key="predict#" + clock.today_str, labels=labels)
+
+    run = dynamo.record_shard(shard["run_id"], shard["segment"], shard["total_segments"], summarize_predict_all(results))
+    if run and len(run["done_shards"]) == run["total_segments"]:
+        summary = {key:run[key] for key in ["run_id","total_segments","users","succeeded","failed","skipped"]}
+        logger.info("[PREDICT_RUN_COMPLETE]:%s", LazyJson(summary))
+    return results
+
+
+class LambdaDispatcher:
+    # asynchronous self-invoke; Lambda retries a failed shard up to twice
+    
+    def __init__(self, function_name=PREDICT_FUNCTION_NAME):
+        self.function_name = function_name
+        self.client = boto3.session.Session().client(
+                     'lambda',
+                     aws_access_key_id=AWS_BOTO3_ACCESS_KEY,
+                     aws_secret_access_key=AWS_BOTO3_SECRET_KEY,
+                     region_name=AWS_REGION)
+
+    def dispatch(self, event):
+        with tracer.span("lambda.invoke", event=next(iter(event))):
+            self.client.invoke(FunctionName=self.function_name, InvocationType="Event", Payload=json.dumps(event))
+
+
+class LocalDispatcher:
+    # runs each shard in this process, for local runs and the offline benchmark
+    
+    def dispatch(self, event):
+        event_handler(event)
+
+
+DISPATCHERS = {"lambda":LambdaDispatcher, "local":LocalDispatcher}
+dispatchers_lock = threading.Lock()
+dispatchers = {}
+
+def dispatcher():
+    # one per container and PREDICT_DISPATCHER, so webhooks reuse the Lambda client
+    with dispatchers_lock:
+        if PREDICT_DISPATCHER not in dispatchers:
+            dispatchers[PREDICT_DISPATCHER] = DISPATCHERS[PREDICT_DISPATCHER]()
+        return dispatchers[PREDICT_DISPATCHER]
+
+
+def prepare_prediction_safely(m_user, clock):
+    
+    # returns the user's tables for the batched Model, or a finished prediction
+    # when PREDICT_SOURCE already predicts per user
+    line_mid = m_user["line_mid"]
+    start = time.time()
+    tables = None
+    prediction = None
+
+    backoff = fitbit_rate_limit.backoff_seconds(line_mid)
+    if backoff:
+        logger.info("[PREDICT_SKIPPED]:{{line_mid:{},reason:rate_limit,backoff:{:.0f}}}".format(line_mid, backoff))
+        return {"line_mid":line_mid, "ok":False, "elapsed":0, "skipped":True}, tables, prediction
+
+    try:
+        # one client per user, so the token is checked and refreshed once
+        fb = ExFitbit(m_user, clock)
+        last_sync_time = None
+        if PREDICT_CHANGE_DETECTION:
+            last_sync_time = fb.get_last_sync_time()
+            if last_sync_time and m_user.get("last_sync_time") and last_sync_time <= m_user["last_sync_time"]:
+                logger.info("[PREDICT_SKIPPED]:{line_mid:%s,reason:unchanged,last_sync_time:%s}", line_mid, last_sync_time)
+                result = {"line_mid":line_mid, "ok":True, "elapsed":time.time() - start, "skipped":True, "unchanged":True}
+                return result, tables, cached_prediction(m_user, clock)
+
+        if PREDICT_SOURCE == "rolling":
+            prediction = predict_rolling(m_user, clock, fb)
+        elif PREDICT_SOURCE == "features":
+            prediction = predict_features(m_user, clock, fb)
+        elif PREDICT_SOURCE == "columnar":
+            prediction = predict_columnar(m_user, clock, fb)
+        else:
+            tables = fetch_tables(m_user, clock, fb=fb)
+        ok = True
+    except Exception:
+        logger.exception("[PREDICT_FAILED]:{}".format(line_mid))
+        ok = False
+    elapsed = time.time() - start
+    
+    result = {"line_mid":line_mid, "ok":ok, "elapsed":elapsed, "skipped":False}
+    if ok and last_sync_time:
+        result["last_sync_time"] = last_sync_time
+    return result, tables, prediction
+
+
+def cached_prediction(m_user, clock):
+    
+    # the last nightly prediction, with the message looked up again from its idx
+    last_prediction = m_user.get("last_prediction")
+    if PREDICT_UNCHANGED != "cached" or not last_prediction:
+        return None
+    idx, base_date_str = last_prediction["idx"], last_prediction["base_date_str"]
+    return (idx, Model.tmp[idx]), base_date_str, base_date_str == clock.today_str
+
+
+def predict_tables(tables, results, clock):
+    
+    # one batched Model for everyone, falling back to per-user Models if the batch fails
+    if not tables:
+        return {}
+    date_str = clock.today_str
+    start = time.time()
+    try:
+        stacked = [[], [], []]
+        for user_tables in tables.values():
+            for rows, user_rows in zip(stacked, user_tables):
+                rows.extend(user_rows)
+        model = new_model(*stacked, date_str)
+        predictions = model.predict_by_user()
+        predictions = {line_mid:(prediction, model.base_date_strs[line_mid], model.latest_by_user[line_mid])
+                       for line_mid, prediction in predictions.items()}
+        for line_mid in set(tables) - set(predictions):
+            logger.info("[PREDICT_FAILED]:{line_mid:%s,reason:short_history}", line_mid)
+            results[line_mid]["ok"] = False
+    except Exception:
+        logger.exception("[PREDICT_BATCH_FAILED]")
+        predictions = {}
+        for line_mid, user_tables in tables.items():
+            try:
+                model = new_model(*user_tables, date_str)
+                predictions[line_mid] = (model.predict(), model.base_date_str, model.is_latest)
+            except Exception:
+                logger.exception("[PREDICT_FAILED]:{}".format(line_mid))
+                results[line_mid]["ok"] = False
+    logger.info("[PREDICT_BATCH]:{{users:{},elapsed:{:.3f}}}".format(len(predictions), time.time() - start))
+
+    return predictions
+
+
+def summarize_predict_all(results):
+    
+    elapsed = sorted(result["elapsed"] for result in results)
+    failed = [result["line_mid"] for result in results if not result["ok"] and not result["skipped"]]
+    skipped = sum(1 for result in results if result["skipped"])
+    unchanged = sum(1 for result in results if result.get("unchanged"))
+
+    def percentile(q):
+        return round(elapsed[min(len(elapsed) - 1, int(q * len(elapsed)))], 3) if elapsed else 0
+
+    summary = {"users":len(results),
+               "succeeded":len(results) - len(failed) - skipped,
+               "failed":len(failed),
+               "skipped":skipped,
+               "unchanged":unchanged,
+               "failed_line_mids":failed[:PREDICT_SUMMARY_MAX_LINE_MIDS],
+               "latency_avg":round(sum(elapsed) / len(elapsed), 3) if elapsed else 0,
+               "latency_p50":percentile(0.5),
+               "latency_p99":percentile(0.99),
+               "latency_max":round(elapsed[-1], 3) if elapsed else 0,
+               }
+    return summary
 
 
-def line_event_handler(event):
+def log_predict_all_summary(results, labels=None):
+    
+    summary = summarize_predict_all(results)
+    summary.update(labels or {})
+    logger.info("[PREDICT_ALL_SUMMARY]:%s", LazyJson(summary))
+
+
+line_event_executor_lock = threading.Lock()
+line_event_executors = []
+
+def line_event_executor():
+    # one pool per container; its threads and their DynamoDB connections survive warm invocations
+    with line_event_executor_lock:
+        if not line_event_executors:
+            line_event_executors.append(ThreadPoolExecutor(max_workers=LINE_EVENT_WORKERS))
+        return line_event_executors[0]
+
+
+def line_events_handler(events, clock):
+    
+    # users run in parallel, each user's events stay in webhook order
+    events_by_user = collections.OrderedDict()
+    for ev in events:
+        events_by_user.setdefault(ev.get("source", {}).get("userId"), []).append(ev)
+
+    if len(events_by_user) == 1:
+        line_user_events_handler(events, clock)
+        return
+
+    executor = line_event_executor()
+    wait([executor.submit(line_user_events_handler, user_events, clock) for user_events in events_by_user.values()])
+
+
+def line_user_events_handler(events, clock):
+    
+    # repeated おつげ from one user in the same webhook produce a single prediction
+    predicted = False
+    for ev in events:
+        if is_predict_request(ev):
+            if predicted:
+                logger.info("[LINE_EVENT_SKIPPED]:{{user_id:{},reason:duplicate_predict}}".format(ev["source"]["userId"]))
+                continue
+            predicted = True
+        
+        try:
+            line_event_handler(ev, clock)
+        except Exception:
+            logger.exception("[LINE_EVENT_FAILED]:{}".format(ev.get("source", {}).get("userId")))
+
+
+def is_predict_request(event):
+    
+    return (event["type"] == "message"
+            and event["source"]["type"] == "user"
+            and event["message"]["type"] == "text"
+            and "おつげ" in event["message"]["text"])
+
+
+def line_event_handler(event, clock):
     
     type_ = event["type"]
     if type_ != "message":
@@ -558,7 +1928,10 @@ def line_event_handler(event):
     
     # TODO
     if "おつげ" in in_message:
-        predict(m_user)
+        if PREDICT_ASYNC and dispatch_predict_request(event, clock):
+            return
+        # tokens may have been rotated by another container since m_user was cached
+        predict(dynamo.get_m_user(user_id, use_cache=False), clock)
         return
             
     if in_message:
@@ -567,23 +1940,230 @@ def line_event_handler(event):
         line_push(user_id, out_message)
         return        
 
-def predict(m_user):
+def dispatch_predict_request(event, clock):
+    
+    # acknowledges with the reply token and leaves the prediction to an async invocation,
+    # so the webhook returns before Fitbit is called; False lets the caller predict inline
+    user_id = event["source"]["userId"]
+    if event.get("replyToken"):
+        line_reply(event["replyToken"], "計算中…")
+
+    try:
+        dispatcher().dispatch({"PredictRequest":{"line_mid":user_id,
+                                                 "event_id":event.get("webhookEventId") or event["message"]["id"],
+                                                 "now":clock.now.strftime(Clock.FORMAT)}})
+    except Exception:
+        logger.exception("[PREDICT_REQUEST_DISPATCH_FAILED]:{}".format(user_id))
+        return False
+    return True
+
+
+def handle_predict_request(request):
+    
+    # a redelivered webhook event predicts once; a new おつげ while the user's prediction
+    # is still running is dropped, one sent afterwards predicts again. The event key is held
+    # briefly while predicting, so the retry of an invocation that timed out is not dropped,
+    # and kept for IDEMPOTENCY_TTL once the prediction was pushed
+    line_mid = request["line_mid"]
+    event_key = "predict_request#{}".format(request["event_id"])
+    if not dynamo.claim(line_mid, event_key, PREDICT_DEDUP_WINDOW):
+        logger.info("[PREDICT_REQUEST_SKIPPED]:{line_mid:%s,reason:redelivered}", line_mid)
+        return
+    if not dynamo.claim(line_mid, "predict_request", PREDICT_DEDUP_WINDOW):
+        logger.info("[PREDICT_REQUEST_SKIPPED]:{line_mid:%s,reason:in_flight}", line_mid)
+        return
+
+    clock = Clock(datetime.datetime.strptime(request["now"], Clock.FORMAT))
+    try:
+        predict(dynamo.get_m_user(line_mid, use_cache=False), clock)
+    except Exception:
+        logger.exception("[PREDICT_REQUEST_FAILED]:{}".format(line_mid))
+        # a redelivery may try again
+        dynamo.release(line_mid, event_key)
+    else:
+        dynamo.extend(line_mid, event_key)
+    finally:
+        dynamo.release(line_mid, "predict_request")
+
+
+def predict(m_user, clock):
+    
+    if PREDICT_SOURCE == "rolling":
+        push_prediction(m_user["line_mid"], *predict_rolling(m_user, clock))
+        return
+
+    if PREDICT_SOURCE == "features":
+        push_prediction(m_user["line_mid"], *predict_features(m_user, clock))
+        return
+
+    if PREDICT_SOURCE == "columnar":
+        push_prediction(m_user["line_mid"], *predict_columnar(m_user, clock))
+        return
+
+    model = new_model(*fetch_tables(m_user, clock), clock.today_str)
+    push_prediction(m_user["line_mid"], model.predict(), model.base_date_str, model.is_latest)
+
+
+def fetch_tables(m_user, clock, since=None, fb=None):
+    
+    fb = fb or ExFitbit(m_user, clock)
+    tables = fb.update_tbl_sleep(since), fb.update_tbl_heart(since), fb.update_tbl_activities(since)
+    if DAILY_FEATURES_ENABLED:
+        fb.update_tbl_daily_features(*tables)
+    return tables
+
+
+def predict_features(m_user, clock, fb=None):
+    
+    # predicts from the last Model.WINDOW rows of tbl_daily_features; only the days since
+    # the latest stored one are queried and fetched, users without features get all of them
+    date_str = clock.today_str
+    features = dynamo.query_latest(m_user["line_mid"], "tbl_daily_features", Model.WINDOW)
+    since = features[-1]["dateTime"] if features else None
+
+    fb = fb or ExFitbit(m_user, clock)
+    tables = fb.update_tbl_sleep(since), fb.update_tbl_heart(since), fb.update_tbl_activities(since)
+    updated = fb.update_tbl_daily_features(*tables, all_dates=not features)
+
+    state = RollingState()
+    state.update(features + updated, date_str)
+    return state.predict(date_str)
+
+
+def predict_columnar(m_user, clock, fb=None):
+    
+    # predicts from the newest two tbl_history periods, enough for Model.WINDOW days across
+    # a year boundary; new days are appended to their period's item
+    line_mid = m_user["line_mid"]
+    date_str = clock.today_str
+    histories = [ColumnarHistory.from_item(item) for item in dynamo.query_latest(line_mid, "tbl_history", 2)]
+    histories = {history.period:history for history in histories if history}
+    since = histories[max(histories)].last_date_str if histories else None
+
+    fb = fb or ExFitbit(m_user, clock)
+    tables = fb.update_tbl_sleep(since), fb.update_tbl_heart(since), fb.update_tbl_activities(since)
+    updated = fb.update_tbl_daily_features(*tables, all_dates=not histories)
+
+    changed = ColumnarHistory.upsert(histories, line_mid, updated)
+    if len(changed) > 0:
+        dynamo.batch_write("tbl_history", [history.to_item() for history in changed])
+
+    return ColumnarHistory.predict(histories, date_str)
+
+
+def stored_features(line_mid):
+    
+    # daily_features over everything stored for the user, without calling Fitbit
+    tables = (dynamo.query_by_datetime(line_mid, "tbl_sleep", "endTime", BACKFILL_SINCE + "T00:00:00.000"),
+              dynamo.query_by_datetime(line_mid, "tbl_heart", "dateTime", BACKFILL_SINCE),
+              dynamo.query_by_datetime(line_mid, "tbl_activities", "dateTime", BACKFILL_SINCE))
+    return daily_features(*tables)
+
+
+def migrate_columnar_history(line_mids=None, max_workers=BACKFILL_WORKERS):
+    
+    # packs the stored tables of existing users into tbl_history items; reruns rewrite them whole
+    if not line_mids:
+        line_mids = [m_user["line_mid"] for m_user in dynamo.scan_m_user(SCAN_TOTAL_SEGMENTS, ["line_mid"])]
+
+    def migrate(line_mid):
+        histories = ColumnarHistory.upsert({}, line_mid, stored_features(line_mid))
+        if len(histories) > 0:
+            dynamo.batch_write("tbl_history", [history.to_item() for history in histories])
+        return sum(history.values.shape[1] for history in histories)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        counts = dict(zip(line_mids, executor.map(migrate, line_mids)))
+
+    logger.info("[MIGRATE_COLUMNAR_HISTORY]:{users:%s,days:%s}", len(counts), sum(counts.values()))
+    return counts
+
+
+def backfill_daily_features(line_mids=None, max_workers=BACKFILL_WORKERS):
+    
+    # derives tbl_daily_features from the stored tables of existing users, without calling Fitbit
+    if not line_mids:
+        line_mids = [m_user["line_mid"] for m_user in dynamo.scan_m_user(SCAN_TOTAL_SEGMENTS, ["line_mid"])]
+
+    def backfill(line_mid):
+        features = stored_features(line_mid)
+        if len(features) > 0:
+            dynamo.batch_write("tbl_daily_features", features)
+        return len(features)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        counts = dict(zip(line_mids, executor.map(backfill, line_mids)))
+
+    logger.info("[BACKFILL_DAILY_FEATURES]:{users:%s,features:%s}", len(counts), sum(counts.values()))
+    return counts
+
+
+def backfill_history(line_mids, clock, days=BASE_PERIOD, max_workers=BACKFILL_WORKERS):
     
-    fb = ExFitbit(m_user)
-    model = Model(fb.update_tbl_sleep(),
-                  fb.update_tbl_heart(),
-                  fb.update_tbl_activities(),
-                  datetime.datetime.strftime(DATETIME_NOW, "%Y-%m-%d"))
-    prediction = model.predict()
+    # fetches the days between BASE_PERIOD and HISTORY_PERIOD ago that first syncs skip;
+    # rows already stored are not written again, so reruns only cost Fitbit calls
+    if not line_mids:
+        line_mids = [m_user["line_mid"] for m_user in dynamo.scan_m_user(SCAN_TOTAL_SEGMENTS, ["line_mid"])]
+    base_date, end_date = clock.date_str(days), clock.date_str(HISTORY_PERIOD + 1)
+
+    def backfill(line_mid):
+        try:
+            fb = ExFitbit(dynamo.get_m_user(line_mid, use_cache=False), clock)
+            tables = (fb.update_tbl_sleep(base_date, base_date, end_date),
+                      fb.update_tbl_heart(base_date, base_date, end_date),
+                      fb.update_tbl_activities(base_date, base_date, end_date))
+            return len(fb.update_tbl_daily_features(*tables))
+        except Exception:
+            logger.exception("[BACKFILL_HISTORY_FAILED]:{}".format(line_mid))
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        counts = dict(zip(line_mids, executor.map(backfill, line_mids)))
+
+    failed = [line_mid for line_mid, count in counts.items() if count is None]
+    logger.info("[BACKFILL_HISTORY]:{users:%s,failed:%s,range:%s..%s}", len(counts), len(failed), base_date, end_date)
+    return counts
+
+
+def predict_rolling(m_user, clock, fb=None):
+    
+    # only the days since the last stored one are queried and fetched;
+    # a missing or stale state is rebuilt from the full tables
+    date_str = clock.today_str
+    state = RollingState.from_item(m_user.get("rolling_state"))
+    
+    if not state or state.is_stale(date_str):
+        logger.info("[ROLLING_STATE]:{{line_mid:{},rebuild:True}}".format(m_user["line_mid"]))
+        state = RollingState()
+        state.update(daily_features(*fetch_tables(m_user, clock, fb=fb)), date_str)
+    else:
+        state.update(daily_features(*fetch_tables(m_user, clock, state.dates[-1], fb)), date_str)
+
+    dynamo.update(m_user["line_mid"], "m_user", {"rolling_state":state.to_item()})
+    m_user["rolling_state"] = state.to_item()
+    
+    return state.predict(date_str)
+
+
+def push_prediction(line_mid, prediction, base_date_str, is_latest, delivery=None):
+    
+    # both messages share one push; a caller-supplied delivery is flushed by the caller
+    flush = delivery is None
+    delivery = delivery or LineDelivery()
+
     out_message = "{}\n[指標:{}]".format(prediction[1],prediction[0])
-    line_push(m_user["line_mid"], out_message)
+    delivery.push(line_mid, out_message)
     
-    if not model.is_latest:
-        out_message = "ちなみに予測元データの日付は{}だよ。\n最新データにするにはFitbitアプリでデータ同期をしてから、もう一度「おつげ」と声をかけてね。".format(model.base_date_str)
-        line_push(m_user["line_mid"], out_message)
+    if not is_latest:
+        out_message = "ちなみに予測元データの日付は{}だよ。\n最新データにするにはFitbitアプリでデータ同期をしてから、もう一度「おつげ」と声をかけてね。".format(base_date_str)
+        delivery.push(line_mid, out_message)
+
+    # a push that did not go out fails the prediction, so callers holding a claim release it
+    if flush and delivery.flush():
+        raise RuntimeError("LINE delivery failed: {}".format(line_mid))
         
         
-def line_create_message_data(text):
+def line_create_message_data(*texts):
     
     return {
         "messages": [
@@ -591,24 +2171,146 @@ def line_create_message_data(text):
                 "type": "text",
                 "text": text
             }
+            for text in texts
         ]
     }
       
 def line_reply(token, message):
     
-    logger.info("[LINE_REPLY]:{}".format(message))
+    logger.info("[LINE_REPLY]:%s", message)
     data = line_create_message_data(message)
     data["replyToken"] = token
-    requests.post(LINE_URL_REPLY, data=json.dumps(data), headers=LINE_HEADERS)
+    line_post(LINE_URL_REPLY, data, retry=False)
 
 def line_push(to, message):    
     
-    logger.info("[LINE_PUSH]:{{to:{},message:{}}}".format(to, message))
+    logger.info("[LINE_PUSH]:{to:%s,message:%s}", to, message)
     data = line_create_message_data(message)
     data["to"] = to
-    requests.post(LINE_URL_PUSH, data=json.dumps(data), headers=LINE_HEADERS)
+    line_post(LINE_URL_PUSH, data)
+
+def line_multicast(to, messages):
+    
+    logger.info("[LINE_MULTICAST]:{to_cnt:%s,messages:%s}", len(to), messages)
+    data = line_create_message_data(*messages)
+    data["to"] = to
+    return line_post(LINE_URL_MULTICAST, data)
+
+def line_post(url, data, retry=True):
+    
+    # the retry key lets LINE drop duplicates when a retried push or multicast had already been
+    # accepted; replies support no retry key and their token is single-use, so they are sent once
+    headers = dict(LINE_HEADERS, **{"X-Line-Retry-Key":str(uuid.uuid4())}) if retry else LINE_HEADERS
+    with tracer.span("line.post", endpoint=url.rsplit("/", 1)[-1]):
+        return http_session(retry_posts=retry).post(url, data=json.dumps(data), headers=headers, timeout=HTTP_TIMEOUT)
+
+
+class LineDelivery:
     
-def convert_to_decimal(dict_):
-    return json.loads(json.dumps(dict_), parse_float=decimal.Decimal)
+    def __init__(self):
+        self.messages = {}
+        self.lock = threading.Lock()
+
+    def push(self, to, message):
+        with self.lock:
+            self.messages.setdefault(to, []).append(message)
+
+    def flush(self, before_send=None):
+        # combines up to LINE_MAX_MESSAGES messages per user and multicasts identical
+        # message lists; returns the users whose delivery failed. before_send gets each
+        # chunk of users right before it is sent and returns the ones to send to
+        with self.lock:
+            messages, self.messages = self.messages, {}
+
+        recipients = {}
+        for to, texts in messages.items():
+            for i in range(0, len(texts), LINE_MAX_MESSAGES):
+                recipients.setdefault(tuple(texts[i:i+LINE_MAX_MESSAGES]), []).append(to)
+
+        failed = []
+        for texts, to in recipients.items():
+            for i in range(0, len(to), LINE_MAX_MULTICAST):
+                chunk = to[i:i+LINE_MAX_MULTICAST]
+                try:
+                    if before_send:
+                        chunk = before_send(chunk)
+                    if not chunk:
+                        continue
+                    if len(chunk) == 1:
+                        logger.info("[LINE_PUSH]:{to:%s,messages:%s}", chunk[0], texts)
+                        data = line_create_message_data(*texts)
+                        data["to"] = chunk[0]
+                        res = line_post(LINE_URL_PUSH, data)
+                    else:
+                        res = line_multicast(chunk, texts)
+                    res.raise_for_status()
+                except Exception:
+                    logger.exception("[LINE_DELIVERY_FAILED]:{}".format(chunk))
+                    failed.extend(chunk)
+
+        return failed
+
+
+http_session_lock = threading.Lock()
+http_sessions = {}
+
+def http_session(retry_posts=False):
+    # one keep-alive session per container and retry policy, with timeouts passed per call and
+    # retries with backoff; POSTs are retried after a response or read error only where the API
+    # drops duplicates (LINE's retry key), elsewhere only when the connection could not be made
+    with http_session_lock:
+        if retry_posts not in http_sessions:
+            from urllib3.util.retry import Retry
+            retry_kwargs = {"total":HTTP_RETRIES,
+                            "backoff_factor":HTTP_BACKOFF,
+                            "status_forcelist":[429, 500, 502, 503, 504],
+                            }
+            if not retry_posts:
+                retry = Retry(**retry_kwargs)
+            else:
+                try:
+                    retry = Retry(allowed_methods=False, **retry_kwargs)
+                except TypeError:
+                    retry = Retry(method_whitelist=False, **retry_kwargs)
+            session = requests.Session()
+            session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=PREDICT_ALL_WORKERS, max_retries=retry))
+            http_sessions[retry_posts] = session
+        return http_sessions[retry_posts]
+    
+def to_dynamo(value):
+    # floats become Decimal(repr(value)) exactly as the former json round trip produced,
+    # NaN/inf become None, numpy scalars and arrays are unwrapped first
+    # (np.float64 is a float subclass whose repr is "np.float64(...)" on NumPy 2)
+    if type(value).__module__ == "numpy":
+        return to_dynamo(value.tolist())
+    if isinstance(value, float):
+        if value != value or value in (float("inf"), float("-inf")):
+            return None
+        return decimal.Decimal(float.__repr__(value))
+    if isinstance(value, (str, int, decimal.Decimal)) or value is None:
+        return value
+    if isinstance(value, dict):
+        return {key:to_dynamo(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_dynamo(item) for item in value]
+    return value
+
+def from_dynamo(value):
+    # DynamoDB numbers come back as Decimal; integral ones become int, the rest float
+    if isinstance(value, decimal.Decimal):
+        if value == value.to_integral_value():
+            return int(value)
+        return float(value)
+    if isinstance(value, dict):
+        return {key:from_dynamo(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [from_dynamo(item) for item in value]
+    if isinstance(value, set):
+        return {from_dynamo(item) for item in value}
+    return value
 
+tracer = Tracer()
 dynamo = DynamoDB()
+write_behind = WriteBehind()
+fitbit_cache = FitbitCache.from_setting(FITBIT_CACHE_BACKEND)
+fitbit_rate_limit = FitbitRateLimit()